@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import os
+import json
+import yaml
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def config_hash(config):
+    """A stable hash of a (redacted) config used to make sure a build is resumed with the same manifest"""
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class Checkpoint(object):
+    """The phases of a build that have completed along with the DNF cache holding the downloaded packages
+    and the NEVRAs of the packages being installed.  Phases are tracked in memory and only written to disk
+    by save(), which BuildCommand calls when a build fails.  A Checkpoint without a path is never written."""
+    def __init__(self, path=None):
+        self.path = path
+        self.completed = []
+        self.cache_dir = None
+        self.manifest_hash = None
+        self.packages = []
+
+    def exists(self):
+        return self.path is not None and os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            data = yaml.safe_load(f)
+        self.completed = data.get('completed', [])
+        self.cache_dir = data.get('cache_dir')
+        self.manifest_hash = data.get('manifest_hash')
+        self.packages = data.get('packages', [])
+        log.debug("Loaded checkpoint %s with completed phases %s" % (self.path, self.completed))
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            'completed': self.completed,
+            'cache_dir': self.cache_dir,
+            'manifest_hash': self.manifest_hash,
+            'packages': self.packages,
+        }
+        with open(self.path, 'w') as f:
+            yaml.safe_dump(data, f, default_flow_style=False)
+        log.info("Wrote checkpoint %s" % self.path)
+
+    def remove(self):
+        if self.exists():
+            os.unlink(self.path)
+            log.info("Deleted checkpoint %s" % self.path)
+
+    def done(self, phase):
+        return phase in self.completed
+
+    def complete(self, phase):
+        if phase not in self.completed:
+            self.completed.append(phase)
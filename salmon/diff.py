@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+
+import os
+import re
+import stat
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+import collections
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+BTRFS_SUBVOLUME_INO = 256
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# `btrfs receive --dump` prints a command, a path with whitespace and backslashes escaped, and then
+# key=value pairs
+DUMP_RE = re.compile(r"^(\S+)\s+((?:\\.|\S)+)\s*(.*)$")
+ESCAPE_RE = re.compile(r"\\(?:([^0-7])|([0-7]{3}))")
+ESCAPES = {'a': '\a', 'b': '\b', 'e': '\x1b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+XATTR_COMMANDS = set(['set_xattr', 'remove_xattr'])
+
+
+def is_subvolume(path):
+    return os.stat(path).st_ino == BTRFS_SUBVOLUME_INO
+
+
+def subvolume_info(path):
+    """Parse the fields of `btrfs subvolume show` that relate snapshots to their source"""
+    output = subprocess.check_output(['btrfs', 'subvolume', 'show', path], universal_newlines=True)
+    info = {}
+    for line in output.splitlines():
+        key, sep, value = line.strip().partition(':')
+        if sep:
+            info[key.strip()] = value.strip()
+    return {'uuid': info.get('UUID'), 'parent_uuid': info.get('Parent UUID')}
+
+
+def related(old_info, new_info):
+    """Whether one of the subvolumes is a snapshot of the other"""
+    return new_info['parent_uuid'] == old_info['uuid'] or old_info['parent_uuid'] == new_info['uuid']
+
+
+def is_read_only(path):
+    output = subprocess.check_output(['btrfs', 'property', 'get', '-ts', path, 'ro'], universal_newlines=True)
+    return output.strip() == 'ro=true'
+
+
+@contextmanager
+def read_only(path):
+    """Yield a read-only view of the subvolume at path, which btrfs send requires.  Writable subvolumes
+    get a temporary read-only snapshot next to them.  It shares all of its blocks with the original, so
+    it costs next to nothing and keeps the send stream proportional to the change."""
+    if is_read_only(path):
+        yield path
+        return
+
+    snapshot_dir = tempfile.mkdtemp(prefix='.salmon-diff-', dir=os.path.dirname(os.path.abspath(path)))
+    snapshot = os.path.join(snapshot_dir, os.path.basename(path))
+    subprocess.check_output(['btrfs', 'subvolume', 'snapshot', '-r', path, snapshot])
+    try:
+        yield snapshot
+    finally:
+        subprocess.check_output(['btrfs', 'subvolume', 'delete', snapshot])
+        os.rmdir(snapshot_dir)
+
+
+def send_stream(old, new):
+    """The metadata of an incremental send from old to new as printed by `btrfs receive --dump`"""
+    send = subprocess.Popen(['btrfs', 'send', '--no-data', '-p', old, new], stdout=subprocess.PIPE)
+    try:
+        output = subprocess.check_output(['btrfs', 'receive', '--dump'], stdin=send.stdout, universal_newlines=True)
+    finally:
+        send.stdout.close()
+        if send.wait() != 0:
+            raise subprocess.CalledProcessError(send.returncode, 'btrfs send')
+    return output
+
+
+def unescape(text):
+    """Undo the escaping `btrfs receive --dump` applies to paths"""
+    def replace(match):
+        if match.group(2):
+            return chr(int(match.group(2), 8))
+        return ESCAPES.get(match.group(1), match.group(1))
+    return ESCAPE_RE.sub(replace, text)
+
+
+def parse_dump(output):
+    """Map each path named in a send stream dump to the set of commands that touched it.  Paths are made
+    relative to the subvolume, e.g. './snap/etc/hostname' becomes '/etc/hostname'.  Renames and links
+    count against both the source and the destination."""
+    touched = collections.defaultdict(set)
+
+    def relative_path(path):
+        # Drop the leading './' and the name of the subvolume being sent
+        parts = path.split('/', 2)
+        return '/' + (parts[2].rstrip('/') if len(parts) > 2 else '')
+
+    for line in output.splitlines():
+        match = DUMP_RE.match(line)
+        if not match or match.group(1) in ['snapshot', 'subvol']:
+            continue
+        command, path, rest = match.groups()
+        touched[relative_path(unescape(path))].add(command)
+        if command in ['rename', 'link'] and 'dest=' in rest:
+            touched[relative_path(unescape(rest.split('dest=', 1)[1]))].add(command)
+    return touched
+
+
+def send_diff(old, new, workers=4):
+    """Diff two subvolumes where one is a snapshot of the other.  An incremental `btrfs send --no-data`
+    from one to the other walks only the parts of the trees that differ, and names every path that was
+    written, truncated, created, unlinked, renamed, chmod'ed, chown'ed or had its xattrs changed.  Only
+    those paths are compared.  Returns None if the subvolumes aren't related."""
+    if not related(subvolume_info(old), subvolume_info(new)):
+        return None
+
+    with read_only(old) as old_ro, read_only(new) as new_ro:
+        touched = parse_dump(send_stream(old_ro, new_ro))
+        log.debug("The send stream touched %d paths" % len(touched))
+        # Only a handful of paths are compared, so hash them all rather than trusting mtimes
+        result = compare(old_ro, new_ro, set(touched), workers, checksum=True)
+
+        # compare() doesn't look at xattrs, e.g. SELinux labels, so trust the stream for those
+        modified = set(result['modified'])
+        for path, commands in touched.items():
+            rel = path.lstrip('/')
+            if commands & XATTR_COMMANDS and lstat(os.path.join(old_ro, rel)) and lstat(os.path.join(new_ro, rel)):
+                modified.add(path)
+        result['modified'] = sorted(modified)
+    return result
+
+
+def relative(path, root):
+    rel = os.path.relpath(path, root)
+    return '/' if rel == '.' else '/' + rel
+
+
+def scan_diff(old, new, workers=4, checksum=False):
+    """Diff two arbitrary trees by walking both.  Files whose size and mtime match are considered
+    unchanged unless checksum is set."""
+    old_files = walk_tree(old)
+    new_files = walk_tree(new)
+    return compare(old, new, set(old_files) | set(new_files), workers, checksum)
+
+
+def walk_tree(root):
+    paths = []
+    for d, dirs, files in os.walk(root):
+        rel = relative(d, root)
+        paths.extend(os.path.join(rel, e) for e in dirs + files)
+    return paths
+
+
+def compare(old, new, candidates, workers=4, checksum=False):
+    """Classify each candidate path as added, modified or deleted between the two trees.  Cheap stat
+    checks settle most paths.  Regular files with the same size are hashed, in parallel, when their
+    mtimes differ or checksum is set."""
+    result = {'added': set(), 'modified': set(), 'deleted': set()}
+    to_hash = []
+
+    for path in candidates:
+        rel = path.lstrip('/')
+        old_st = lstat(os.path.join(old, rel))
+        new_st = lstat(os.path.join(new, rel))
+
+        if old_st is None and new_st is None:
+            continue
+        elif old_st is None:
+            result['added'].add(path)
+            if stat.S_ISDIR(new_st.st_mode):
+                result['added'].update(path + p for p in walk_tree(os.path.join(new, rel)))
+        elif new_st is None:
+            result['deleted'].add(path)
+            if stat.S_ISDIR(old_st.st_mode):
+                result['deleted'].update(path + p for p in walk_tree(os.path.join(old, rel)))
+        elif stat.S_IFMT(old_st.st_mode) != stat.S_IFMT(new_st.st_mode) or old_st.st_mode != new_st.st_mode:
+            result['modified'].add(path)
+        elif (old_st.st_uid, old_st.st_gid) != (new_st.st_uid, new_st.st_gid):
+            result['modified'].add(path)
+        elif stat.S_ISLNK(old_st.st_mode):
+            if os.readlink(os.path.join(old, rel)) != os.readlink(os.path.join(new, rel)):
+                result['modified'].add(path)
+        elif stat.S_ISREG(old_st.st_mode):
+            if old_st.st_size != new_st.st_size:
+                result['modified'].add(path)
+            elif checksum or old_st.st_mtime != new_st.st_mtime:
+                to_hash.append(path)
+
+    result['modified'].update(differing_files(old, new, to_hash, workers))
+    return dict((k, sorted(v)) for k, v in result.items())
+
+
+def lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def differing_files(old, new, paths, workers=4):
+    """Hash each path in both trees with a pool of threads and return the ones whose contents differ.
+    hashlib releases the GIL on large buffers so the threads really do run in parallel."""
+    pending = list(paths)
+    differing = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+            rel = path.lstrip('/')
+            if hash_file(os.path.join(old, rel)) != hash_file(os.path.join(new, rel)):
+                with lock:
+                    differing.append(path)
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(pending)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return differing
@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+
+import os
+import time
+import sqlite3
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join('/', 'var', 'lib', 'salmon', 'inventory.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS containers (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    manifest_hash TEXT,
+    subvolume INTEGER NOT NULL,
+    base_image TEXT,
+    logical_size INTEGER,
+    disk_size INTEGER,
+    built REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS containers_name ON containers (name);
+CREATE TABLE IF NOT EXISTS packages (
+    path TEXT NOT NULL,
+    nevra TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_path ON packages (path);
+CREATE INDEX IF NOT EXISTS packages_nevra ON packages (nevra);
+CREATE TABLE IF NOT EXISTS phases (
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_path ON phases (path);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    manifest_hash TEXT,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_path ON history (path);
+"""
+
+CONTAINER_COLUMNS = [
+    'path', 'name', 'destination', 'manifest_hash', 'subvolume', 'base_image', 'logical_size', 'disk_size', 'built'
+]
+
+
+class Inventory(object):
+    """A SQLite index of the containers Salmon has built.  Builds and deletes record themselves here so
+    that listing containers doesn't mean walking every destination and querying each rpmdb.  The
+    database and its directory are created the first time they are needed."""
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_PATH
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def record_build(self, container):
+        """Replace whatever is known about the container at container['path'].  container holds the
+        CONTAINER_COLUMNS plus 'packages', a list of NEVRAs, and 'phases', a list of (phase, seconds)."""
+        path = container['path']
+        now = time.time()
+        row = dict((c, container.get(c)) for c in CONTAINER_COLUMNS)
+        row['subvolume'] = int(bool(row['subvolume']))
+        row['built'] = row['built'] or now
+
+        with self.conn:
+            self.forget(path)
+            self.conn.execute(
+                "INSERT INTO containers (%s) VALUES (%s)" % (
+                    ", ".join(CONTAINER_COLUMNS), ", ".join("?" * len(CONTAINER_COLUMNS))
+                ),
+                [row[c] for c in CONTAINER_COLUMNS]
+            )
+            self.conn.executemany(
+                "INSERT INTO packages (path, nevra) VALUES (?, ?)",
+                [(path, nevra) for nevra in container.get('packages') or []]
+            )
+            self.conn.executemany(
+                "INSERT INTO phases (path, position, phase, seconds) VALUES (?, ?, ?, ?)",
+                [(path, i, phase, seconds) for i, (phase, seconds) in enumerate(container.get('phases') or [])]
+            )
+            self.add_history(path, row['name'], 'build', row['manifest_hash'], now)
+        log.debug("Recorded build of %s in %s" % (path, self.path))
+
+    def record_delete(self, path, name):
+        with self.conn:
+            existing = self.conn.execute("SELECT manifest_hash FROM containers WHERE path = ?", [path]).fetchone()
+            self.forget(path)
+            self.add_history(path, name, 'delete', existing['manifest_hash'] if existing else None, time.time())
+        log.debug("Recorded deletion of %s in %s" % (path, self.path))
+
+    def forget(self, path):
+        for table in ['containers', 'packages', 'phases']:
+            self.conn.execute("DELETE FROM %s WHERE path = ?" % table, [path])
+
+    def add_history(self, path, name, action, manifest_hash, when):
+        self.conn.execute(
+            "INSERT INTO history (path, name, action, manifest_hash, time) VALUES (?, ?, ?, ?, ?)",
+            [path, name, action, manifest_hash, when]
+        )
+
+    def containers(self):
+        """Every known container with its package count, ordered by name"""
+        rows = self.conn.execute(
+            "SELECT c.*, (SELECT COUNT(*) FROM packages p WHERE p.path = c.path) AS package_count "
+            "FROM containers c ORDER BY c.name, c.path"
+        )
+        return [self.container_dict(r) for r in rows]
+
+    def find(self, name_or_path):
+        """The containers with the given name or at the given path, with their packages, phase timings
+        and history"""
+        rows = self.conn.execute(
+            "SELECT * FROM containers WHERE name = ? OR path = ? ORDER BY path",
+            [name_or_path, os.path.abspath(name_or_path)]
+        ).fetchall()
+
+        found = []
+        for r in rows:
+            container = self.container_dict(r)
+            container['packages'] = [p['nevra'] for p in self.conn.execute(
+                "SELECT nevra FROM packages WHERE path = ? ORDER BY nevra", [r['path']]
+            )]
+            container['phases'] = [(p['phase'], p['seconds']) for p in self.conn.execute(
+                "SELECT phase, seconds FROM phases WHERE path = ? ORDER BY position", [r['path']]
+            )]
+            container['history'] = [dict(h) for h in self.conn.execute(
+                "SELECT action, manifest_hash, time FROM history WHERE path = ? ORDER BY id", [r['path']]
+            )]
+            found.append(container)
+        return found
+
+    def container_dict(self, row):
+        container = dict((k, row[k]) for k in row.keys())
+        container['subvolume'] = bool(container['subvolume'])
+        return container
@@ -3,6 +3,10 @@ from __future__ import absolute_import
 import crypt
 import os
 import abc
+import json
+import functools
+import hashlib
+import time
 import argparse
 import re
 import sys
@@ -10,14 +14,28 @@ import logging
 import yaml
 import copy
 import shutil
+import sqlite3
+import tarfile
 import tempfile
 import subprocess
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
 import dnf
 import dnf.repo
 import dnf.callback
 import dnf.yum.config
 
+from salmon import checkpoint
+from salmon import diff
+from salmon import inventory
+from salmon import mirrors
+from salmon import profiling
+from salmon import watch
+
 log = logging.getLogger(__name__)
 
 
@@ -93,18 +111,33 @@ class Salmon(object):
         # I also feel that it makes testing a little more flexible.
         self.build_class = BuildCommand.get_instance(subparsers)
         self.delete_class = DeleteCommand.get_instance(subparsers)
+        self.bundle_class = BundleCommand.get_instance(subparsers)
+        self.image_class = ImageCommand.get_instance(subparsers)
+        self.bench_boot_class = BenchBootCommand.get_instance(subparsers)
+        self.diff_class = DiffCommand.get_instance(subparsers)
+        self.list_class = ListCommand.get_instance(subparsers)
+        self.show_class = ShowCommand.get_instance(subparsers)
+        self.watch_class = WatchCommand.get_instance(subparsers)
 
         self.args = parser.parse_args(argv)
 
         # Populate the factory generated subcommand classes with the results
         # from the argument parser.  These attributes need to match the name
-        # the subparser registers.
+        # the subparser registers with any dashes replaced by underscores.
         self.build = self.build_class(self.args)
         self.delete = self.delete_class(self.args)
+        self.bundle = self.bundle_class(self.args)
+        self.image = self.image_class(self.args)
+        self.bench_boot = self.bench_boot_class(self.args)
+        self.diff = self.diff_class(self.args)
+        self.list = self.list_class(self.args)
+        self.show = self.show_class(self.args)
+        self.watch = self.watch_class(self.args)
 
     def run(self):
-        # Get the attribute containing the factory generated class and invoke run()
-        getattr(self, self.args.subcommand).run()
+        # Get the attribute containing the factory generated class and invoke run().  Its result is the
+        # exit status.
+        return getattr(self, self.args.subcommand.replace('-', '_')).run()
 
 
 class BaseCommand(object):
@@ -112,16 +145,26 @@ class BaseCommand(object):
     responsible for building the subparser used to parse the subcommand's arguments."""
     __metaclass__ = abc.ABCMeta
 
+    # Containers built on top of a read-only image keep their writable layer and the mount point
+    # of the shared image in these directories under the destination.  The leading dot keeps
+    # machinectl from listing them as containers.
+    OVERLAY_DIR = '.salmon-overlays'
+    IMAGE_MOUNT_DIR = '.salmon-images'
+    UNIT_DIR = os.path.join('/', 'etc', 'systemd', 'system')
+
     def __init__(self, args):
         self.args = args
         if hasattr(self.args, 'verbose') and self.args.verbose:
             log.setLevel(logging.DEBUG)
+        self.profiler = profiling.get_profiler(getattr(self.args, 'profile', None))
+        self.inventory = inventory.Inventory(getattr(self.args, 'inventory', None))
 
     def run(self):
-        raw_config = yaml.load(self.args.manifest)
-        log.debug("Raw Config is %s" % self.redact(raw_config))
-        self.config = self.validate_config(raw_config)
-        log.debug("Calculated Config is %s" % self.redact(self.config))
+        with self.profiler.phase('config'):
+            raw_config = yaml.load(self.args.manifest)
+            log.debug("Raw Config is %s" % self.redact(raw_config))
+            self.config = self.validate_config(raw_config)
+            log.debug("Calculated Config is %s" % self.redact(self.config))
         return self.do_command()
 
     def redact(self, config):
@@ -134,6 +177,37 @@ class BaseCommand(object):
     def do_command(self):
         return 0
 
+    def find_subvolumes(self, root):
+        """Return the btrfs subvolumes nested under root, deepest first.  A btrfs subvolume is identified
+        by a directory with an inode number of 256."""
+        btrfs_dirs = []
+        for d, dirs, files in os.walk(root, topdown=False):
+            btrfs_dirs.extend(
+                [os.path.join(d, sub) for sub in dirs if os.stat(os.path.join(d, sub)).st_ino == 256]
+            )
+        return btrfs_dirs
+
+    def checkpoint_path(self, config):
+        return os.path.join(config['destination'], '.%s.salmon-checkpoint' % config['name'])
+
+    def overlay_dir(self, config):
+        return os.path.join(config['destination'], self.OVERLAY_DIR, config['name'])
+
+    def image_mount_dir(self, config):
+        """Where the base image is mounted.  Images in different directories may share a name, so the
+        mount point is keyed on a hash of the image's full path as well."""
+        image = os.path.abspath(config['base_image'])
+        image_hash = hashlib.sha256(image.encode('utf-8')).hexdigest()[:16]
+        image_name = os.path.splitext(os.path.basename(image))[0]
+        return os.path.join(config['destination'], self.IMAGE_MOUNT_DIR, '%s-%s' % (image_name, image_hash))
+
+    def nspawn_dropin(self, config):
+        return os.path.join(self.UNIT_DIR, 'systemd-nspawn@%s.service.d' % config['name'], 'salmon-overlay.conf')
+
+    def mount_unit_name(self, where):
+        cmd = ['systemd-escape', '--path', '--suffix=mount', where]
+        return subprocess.check_output(cmd, universal_newlines=True).strip()
+
     def validate_config(self, raw_config):
         config = copy.deepcopy(raw_config)
         required_top_options = {
@@ -183,14 +257,27 @@ class DeleteCommand(BaseCommand):
             default=False,
             help="Show extra output"
         )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--inventory",
+            metavar="DB",
+            help="SQLite inventory of built containers.  Defaults to %s" % inventory.DEFAULT_PATH
+        )
         return cls
 
     def __init__(self, args):
         super(DeleteCommand, self).__init__(args)
 
     def validate_subcommand_config(self, args, config, errors):
-        if not config['subvolume']:
-            errors.append("'delete' can only be used with containers that are subvolumes")
+        config['overlay'] = os.path.isdir(self.overlay_dir(config))
+        config['checkpoint'] = os.path.exists(self.checkpoint_path(config))
+        # A failed build leaves a checkpoint behind even for plain directories, and nothing else cleans those up
+        if not config['subvolume'] and not config['overlay'] and not config['checkpoint']:
+            errors.append("'delete' can only be used with containers that are subvolumes or failed builds")
         return errors
 
     def do_command(self):
@@ -199,23 +286,25 @@ class DeleteCommand(BaseCommand):
         container and one within our container for its /var/lib/machines.  As a result, we need to delete
         two btrfs subvolumes with this command.  We'll do a depth first search through the tree looking for
         directories with an inode number of 256 (which identifies a btrfs subvolume) and then delete each
-        volume in the order we found it.
+        volume in the order we found it.  The same search picks up subvolumes declared in the manifest's
+        filesystem section.
 
         See also http://stackoverflow.com/a/32865333
         """
         container_root = os.path.join(self.config['destination'], self.config['name'])
 
-        btrfs_dirs = []
-        for root, dirs, files in os.walk(container_root, topdown=False):
-            btrfs_dirs.extend(
-                [os.path.join(root, d) for d in dirs if os.stat(os.path.join(root, d)).st_ino == 256]
-            )
-        btrfs_dirs.append(container_root)
+        with self.profiler.phase('delete'):
+            if self.config.get('overlay'):
+                self.delete_overlay(self.config, container_root)
+            elif self.config.get('checkpoint') and not self.config.get('subvolume'):
+                if os.path.isdir(container_root):
+                    shutil.rmtree(container_root)
+                    log.info("Deleted %s" % container_root)
+            else:
+                self.delete_subvolumes(container_root)
 
-        for d in btrfs_dirs:
-            cmd = ['btrfs', 'subvolume', 'delete', d]
-            output = subprocess.check_output(cmd)
-            log.info('`%s` returned "%s"' % (" ".join(cmd), output))
+            if self.config.get('checkpoint'):
+                self.delete_checkpoint(self.config)
 
         if self.config.setdefault('nspawn_file', None):
             nspawn_file = os.path.join('/', 'etc', 'systemd', 'nspawn', '%s.nspawn' % self.config['name'])
@@ -225,12 +314,83 @@ class DeleteCommand(BaseCommand):
             except OSError:
                 log.info("Didn't find %s to delete" % nspawn_file)
 
+        try:
+            self.inventory.record_delete(os.path.abspath(container_root), self.config['name'])
+        except sqlite3.Error as e:
+            log.warning("Could not record the deletion of %s in %s: %s" % (self.config['name'], self.inventory.path, e))
+
+    def delete_subvolumes(self, container_root):
+        btrfs_dirs = self.find_subvolumes(container_root)
+        btrfs_dirs.append(container_root)
+
+        for d in btrfs_dirs:
+            cmd = ['btrfs', 'subvolume', 'delete', d]
+            output = subprocess.check_output(cmd)
+            log.info('`%s` returned "%s"' % (" ".join(cmd), output))
+
+    def delete_checkpoint(self, config):
+        """Remove the checkpoint and saved packages of a build that failed"""
+        build_checkpoint = checkpoint.Checkpoint(self.checkpoint_path(config))
+        build_checkpoint.load()
+        if build_checkpoint.cache_dir and os.path.isdir(build_checkpoint.cache_dir):
+            shutil.rmtree(build_checkpoint.cache_dir)
+            log.info("Deleted %s" % build_checkpoint.cache_dir)
+        build_checkpoint.remove()
+
+    def delete_overlay(self, config, container_root):
+        """Tear down a container built on a read-only image.  Only the container's own writable layer is
+        removed; the shared image stays mounted for any other containers using it."""
+        unit = self.mount_unit_name(container_root)
+        subprocess.check_output(['systemctl', 'stop', unit])
+
+        dropin = self.nspawn_dropin(config)
+        for f in [os.path.join(self.UNIT_DIR, unit), dropin]:
+            try:
+                os.unlink(f)
+                log.info("Deleted %s" % f)
+            except OSError:
+                log.info("Didn't find %s to delete" % f)
+        try:
+            os.rmdir(os.path.dirname(dropin))
+        except OSError:
+            pass
+        subprocess.check_output(['systemctl', 'daemon-reload'])
+
+        overlay_dir = self.overlay_dir(config)
+        if config['subvolume']:
+            cmd = ['btrfs', 'subvolume', 'delete', overlay_dir]
+            output = subprocess.check_output(cmd)
+            log.info('`%s` returned "%s"' % (" ".join(cmd), output))
+        else:
+            shutil.rmtree(overlay_dir)
+        os.rmdir(container_root)
+        log.info("Deleted overlay %s" % overlay_dir)
+
 
 class BuildCommand(BaseCommand):
     # See documentation on Modular Crypt Format (https://pythonhosted.org/passlib/modular_crypt_format.html)
     # Note that this regex will only support MD5, SHA256, SHA512, and bcrypt styles
     CRYPT_RE = re.compile(r"\$(1|5|6|2|2a|2x|2y)\$[a-zA-Z0-9./]+\$?[a-zA-Z0-9./]+")
 
+    SELINUX_TYPE = 'svirt_sandbox_file_t'
+
+    # The repo ID used for the local repo inside a bundle and the name of the file within the
+    # bundle that records what to install from it.
+    BUNDLE_REPO_ID = 'salmon-bundle'
+    BUNDLE_UNCHECKED_REPO_ID = 'salmon-bundle-unchecked'
+    BUNDLE_MANIFEST = 'salmon-bundle.yaml'
+
+    # Repo options that Salmon handles itself and DNF won't recognize
+    CUSTOM_REPO_OPTIONS = ['inject', 'mirrors', 'mirrorlists', 'include', 'exclude']
+
+    # Per-path options in the manifest's filesystem section and the btrfs compression they may ask for
+    COMPRESSION_TYPES = ['zstd', 'lzo', 'zlib']
+    FILESYSTEM_OPTIONS = {'compression', 'cow', 'subvolume'}
+
+    # primary.xml already lists these files, so depending on them doesn't require filelists.
+    # See the file list pattern in createrepo.
+    PRIMARY_FILES_RE = re.compile(r"^(/etc/.*|.*bin/.*|/usr/lib/sendmail)$")
+
     @classmethod
     def get_instance(cls, subparsers):
         parser = subparsers.add_parser('build', help='build an nspawn container')
@@ -247,6 +407,11 @@ class BuildCommand(BaseCommand):
             default=False,
             help="Show extra output"
         )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
         parser.add_argument(
             "--destination",
             help="Override destination directory"
@@ -285,10 +450,46 @@ class BuildCommand(BaseCommand):
             default=None,
             help="Do not use a btrfs subvolume for this container"
         )
+        parser.add_argument(
+            "--bundle",
+            help="Install from a bundle created by 'salmon bundle' instead of the manifest's repos"
+        )
+        parser.add_argument(
+            "--base-image",
+            help="Create a writable overlay on top of a read-only image made by 'salmon image' instead of installing packages"
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Continue a build that failed, skipping the phases that completed"
+        )
+        parser.add_argument(
+            "--inventory",
+            metavar="DB",
+            help="SQLite inventory of built containers.  Defaults to %s" % inventory.DEFAULT_PATH
+        )
         return cls
 
     def __init__(self, args):
         super(BuildCommand, self).__init__(args)
+        self.bundle_dir = None
+        # The repos in the bundle as recorded by write_bundle().  Bundles from before it recorded them hold
+        # a single repo at their root.
+        self.bundle_repos = None
+        self.mirror_urls = {}
+        self.filelists = False
+        self.checkpoint = checkpoint.Checkpoint()
+
+    def validate_metadata_config(self, config, errors):
+        if config.setdefault('filelists', 'auto') not in ['auto', True, False]:
+            errors.append("The 'filelists' setting must be auto, True or False")
+
+        for repo_id, repo_opts in config.get('repos', {}).items():
+            for opt in ['include', 'exclude']:
+                if not isinstance(repo_opts.get(opt, []), list):
+                    errors.append("The '%s' setting for repo %s must be a list" % (opt, repo_id))
+        return errors
 
     def validate_subcommand_config(self, args, config, errors):
         if args.destination:
@@ -315,41 +516,415 @@ class BuildCommand(BaseCommand):
             config['root_password'] = args.root_password
 
         config.setdefault('nspawn_file', None)
+
+        config.setdefault('bundle', None)
+        if args.bundle:
+            path = os.path.abspath(os.path.expanduser(args.bundle))
+            if os.path.isfile(path) and tarfile.is_tarfile(path):
+                config['bundle'] = path
+                log.info("Using bundle '%s' from the command line" % path)
+            else:
+                errors.append("Cannot read bundle %s" % path)
+
+        config.setdefault('base_image', None)
+        if args.base_image:
+            path = os.path.abspath(os.path.expanduser(args.base_image))
+            if os.path.isfile(path):
+                config['base_image'] = path
+                log.info("Using base image '%s' from the command line" % path)
+            else:
+                errors.append("Cannot read base image %s" % path)
+        if config['base_image'] and config['bundle']:
+            errors.append("A bundle cannot be used with a base image")
+
+        self.validate_metadata_config(config, errors)
+        self.validate_filesystem_config(config, errors)
+        return errors
+
+    def validate_filesystem_config(self, config, errors):
+        filesystem = config.setdefault('filesystem', None)
+        if not filesystem:
+            return errors
+
+        if config['base_image']:
+            errors.append("The filesystem section cannot be used with a base image")
+
+        for path, opts in filesystem.items():
+            if not os.path.isabs(path) or os.path.normpath(path) == '/':
+                errors.append("Filesystem path %s must be an absolute path below /" % path)
+            if any(c in path for c in '*?['):
+                errors.append(
+                    "Filesystem path %s cannot be a glob.  Settings are inherited by new files, so set them on the parent." % path
+                )
+            if not isinstance(opts, dict):
+                errors.append("Settings for filesystem path %s must be a mapping" % path)
+                continue
+
+            unknown = set(opts.keys()).difference(self.FILESYSTEM_OPTIONS)
+            if unknown:
+                errors.append("Unknown settings %s for filesystem path %s" % (", ".join(sorted(unknown)), path))
+            if opts.get('compression') is not None and opts['compression'] not in self.COMPRESSION_TYPES:
+                errors.append("Compression for %s must be one of %s" % (path, ", ".join(self.COMPRESSION_TYPES)))
+            if opts.get('cow', True) not in [True, False]:
+                errors.append("The 'cow' setting for %s must be either True or False" % path)
+            if opts.get('subvolume', False) not in [True, False]:
+                errors.append("The 'subvolume' setting for %s must be either True or False" % path)
+            elif opts.get('subvolume') and not config['subvolume']:
+                # 'delete' only handles containers that are subvolumes
+                errors.append("Filesystem path %s can only be a subvolume if the container is one" % path)
         return errors
 
     def do_command(self):
-        self.dnf_temp_cache = tempfile.mkdtemp(prefix="salmon_dnf_cache_")
         self.container_dir = os.path.join(self.config['destination'], self.config['name'])
+        self.load_checkpoint(self.config)
 
-        if self.config['subvolume']:
-            # Not a huge fan of shelling out, but didn't see any mature Python Btrfs bindings
-            cmd = ['btrfs', 'subvolume', 'create', self.container_dir]
-
-            output = subprocess.check_output(cmd)
-            log.info("%s returned %s" % (" ".join(cmd), output))
+        if self.checkpoint.cache_dir and os.path.isdir(self.checkpoint.cache_dir):
+            self.dnf_temp_cache = self.checkpoint.cache_dir
         else:
-            os.mkdir(self.container_dir)
+            self.dnf_temp_cache = tempfile.mkdtemp(prefix="salmon_dnf_cache_")
 
         try:
-            dnf_base = self.build_dnf(self.config)
-            self.run_dnf(dnf_base, self.config)
-            self.post_dnf_run(dnf_base, self.config)
-        finally:
-            shutil.rmtree(self.dnf_temp_cache)
+            if self.config.get('base_image'):
+                self.run_phase('create_overlay', self.create_overlay, self.config)
+            else:
+                self.create_root(self.config)
+            self.post_creation(self.config)
+        except BaseException:
+            # Nothing is worth resuming until the container exists.  Checking that also keeps a failed
+            # build from claiming a container that was already there.
+            if self.checkpoint.completed:
+                self.checkpoint.cache_dir = self.dnf_temp_cache
+                self.checkpoint.save()
+                log.error(
+                    "Building %s failed after %s.  Run the build again with --resume to continue from there." %
+                    (self.config['name'], ", ".join(self.checkpoint.completed))
+                )
+            else:
+                shutil.rmtree(self.dnf_temp_cache)
+            raise
 
-        self.post_creation(self.config)
+        shutil.rmtree(self.dnf_temp_cache)
+        self.checkpoint.remove()
+        self.record_build(self.config)
         log.info("Finished %s" % self.config['name'])
+        log.info("Peak memory use was %d KiB" % profiling.peak_rss())
         return 0
 
+    def load_checkpoint(self, config):
+        self.checkpoint = checkpoint.Checkpoint(self.checkpoint_path(config))
+        manifest_hash = checkpoint.config_hash(self.redact(config))
+
+        if self.checkpoint.exists():
+            self.checkpoint.load()
+            if not self.args.resume:
+                raise RuntimeError(
+                    "A failed build of %s left the checkpoint %s and the downloaded packages in %s behind.  Use "
+                    "--resume to continue it or 'delete' to remove the container, the checkpoint and the packages." %
+                    (config['name'], self.checkpoint.path, self.checkpoint.cache_dir)
+                )
+            if self.checkpoint.manifest_hash != manifest_hash:
+                raise RuntimeError("The manifest for %s changed since the build failed and cannot be resumed" % config['name'])
+            log.info("Resuming %s after %s" % (config['name'], ", ".join(self.checkpoint.completed)))
+        elif self.args.resume:
+            log.warning("There is no failed build of %s to resume.  Starting from the beginning." % config['name'])
+
+        self.checkpoint.manifest_hash = manifest_hash
+
+    def record_build(self, config):
+        """Add the finished container to the inventory.  The build itself succeeded, so a broken
+        inventory is only worth a warning."""
+        if config.get('base_image'):
+            # Only the writable layer belongs to this container
+            logical, disk = disk_usage(os.path.join(self.overlay_dir(config), 'upper'))
+        else:
+            logical, disk = disk_usage(self.container_dir)
+
+        try:
+            self.inventory.record_build({
+                'path': os.path.abspath(self.container_dir),
+                'name': config['name'],
+                'destination': config['destination'],
+                'manifest_hash': self.checkpoint.manifest_hash,
+                'subvolume': config.get('subvolume'),
+                'base_image': config.get('base_image'),
+                'logical_size': logical,
+                'disk_size': disk,
+                'packages': self.checkpoint.packages,
+                'phases': list(self.profiler.timings.items()),
+            })
+        except sqlite3.Error as e:
+            log.warning("Could not record %s in %s: %s" % (config['name'], self.inventory.path, e))
+
+    def run_phase(self, name, func, *args):
+        """Run one step of the build unless a previous attempt already completed it"""
+        if self.checkpoint.done(name):
+            log.info("Skipping %s, which completed in a previous attempt" % name)
+            return
+        with self.profiler.phase(name):
+            func(*args)
+        self.checkpoint.complete(name)
+
+    def create_root(self, config):
+        if self.checkpoint.done('install'):
+            log.info("Skipping install, which completed in a previous attempt")
+            return
+
+        if self.checkpoint.done('create'):
+            self.clear_container()
+        else:
+            if config['subvolume']:
+                # Not a huge fan of shelling out, but didn't see any mature Python Btrfs bindings
+                cmd = ['btrfs', 'subvolume', 'create', self.container_dir]
+
+                output = subprocess.check_output(cmd)
+                log.info("%s returned %s" % (" ".join(cmd), output))
+            else:
+                os.mkdir(self.container_dir)
+            self.checkpoint.complete('create')
+
+        if config.get('filesystem'):
+            with self.profiler.phase('filesystem'):
+                self.apply_filesystem(config)
+
+        try:
+            if config.get('bundle'):
+                with self.profiler.phase('unpack_bundle'):
+                    self.bundle_dir = self.unpack_bundle(config)
+            dnf_base = self.build_dnf(config)
+            dnf_base = self.run_dnf(dnf_base, config)
+            with self.profiler.phase('post_dnf_run'):
+                self.post_dnf_run(dnf_base, config)
+        finally:
+            if self.bundle_dir:
+                shutil.rmtree(self.bundle_dir)
+                self.bundle_dir = None
+        self.checkpoint.complete('install')
+
+    def clear_container(self):
+        """A transaction that failed part of the way through can't be run again on top of what it left, so
+        empty the container.  The packages are still in the DNF cache and won't be downloaded again."""
+        log.info("Removing the partial install in %s" % self.container_dir)
+        for d in self.find_subvolumes(self.container_dir):
+            cmd = ['btrfs', 'subvolume', 'delete', d]
+            output = subprocess.check_output(cmd)
+            log.info('`%s` returned "%s"' % (" ".join(cmd), output))
+
+        for entry in os.listdir(self.container_dir):
+            path = os.path.join(self.container_dir, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+    def apply_filesystem(self, config):
+        """Lay out the paths in the manifest's filesystem section before anything is installed.  btrfs
+        compression and the No_COW attribute set on a directory are inherited by files created in it later,
+        so setting them here covers everything the transaction writes.  Parents are handled before their
+        children so that a path can be configured inside a subvolume declared for its parent."""
+        for path in sorted(config['filesystem'], key=lambda p: os.path.normpath(p).count('/')):
+            opts = config['filesystem'][path]
+            target = os.path.join(self.container_dir, os.path.normpath(path).lstrip('/'))
+
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+
+            cmds = []
+            if opts.get('subvolume') and not os.path.isdir(target):
+                cmds.append(['btrfs', 'subvolume', 'create', target])
+            elif not os.path.isdir(target):
+                os.mkdir(target)
+            if opts.get('compression'):
+                cmds.append(['btrfs', 'property', 'set', target, 'compression', opts['compression']])
+            if opts.get('cow') is False:
+                # No_COW only takes effect on files created after it is set, which is why this has to happen
+                # before the transaction
+                cmds.append(['chattr', '+C', target])
+
+            for cmd in cmds:
+                output = subprocess.check_output(cmd)
+                log.info("%s returned %s" % (" ".join(cmd), output))
+
+    def filesystem_report(self, config):
+        """Log how much space the container takes on disk next to its logical size.  compsize knows about
+        btrfs compression and shared extents; without it, allocated blocks are the best estimate."""
+        if which('compsize'):
+            cmd = ['compsize', '-x', self.container_dir]
+            log.info("Disk usage for %s:\n%s" % (self.container_dir, subprocess.check_output(cmd)))
+            return
+
+        paths = [self.container_dir] + [
+            os.path.join(self.container_dir, os.path.normpath(p).lstrip('/')) for p in sorted(config['filesystem'])
+        ]
+        for path in paths:
+            logical, disk = disk_usage(path)
+            log.info("%s: %d bytes on disk, %d bytes logical" % (path, disk, logical))
+
+    def create_overlay(self, config):
+        """Build the container as an overlayfs mount: the read-only image is the lower layer, shared by
+        every container made from it, and only the container's own changes land in its upper layer.
+
+        A .nspawn file cannot replace the container's root with an overlay, so the mounts are written as
+        systemd mount units and a drop-in makes systemd-nspawn@NAME.service require them."""
+        image = config['base_image']
+        image_type = self.image_type(image)
+        lower_dir = self.image_mount_dir(config)
+        overlay_dir = self.overlay_dir(config)
+        upper_dir = os.path.join(overlay_dir, 'upper')
+        work_dir = os.path.join(overlay_dir, 'work')
+
+        # Creating the mount point first makes the build fail before anything is written when a container
+        # of that name is already there
+        os.mkdir(self.container_dir)
+        written = []
+        try:
+            if not os.path.isdir(lower_dir):
+                os.makedirs(lower_dir)
+            if not os.path.isdir(os.path.dirname(overlay_dir)):
+                os.makedirs(os.path.dirname(overlay_dir))
+
+            if config['subvolume']:
+                cmd = ['btrfs', 'subvolume', 'create', overlay_dir]
+                output = subprocess.check_output(cmd)
+                log.info("%s returned %s" % (" ".join(cmd), output))
+            else:
+                os.mkdir(overlay_dir)
+            for d in [upper_dir, work_dir]:
+                os.mkdir(d)
+
+            # Relabelling with restorecon would copy every file up into the overlay, so the SELinux
+            # context is set with a mount option instead.  The image's unit is shared with the other
+            # containers using it, so it is only cleaned up on failure if this build wrote it.
+            context = 'context=system_u:object_r:%s:s0' % self.SELINUX_TYPE
+            image_unit = os.path.join(self.UNIT_DIR, self.mount_unit_name(lower_dir))
+            if not os.path.exists(image_unit):
+                written.append(image_unit)
+            self.write_mount_unit(lower_dir, image, image_type, 'ro,loop,%s' % context)
+            container_unit = self.write_mount_unit(
+                self.container_dir,
+                'overlay',
+                'overlay',
+                'lowerdir=%s,upperdir=%s,workdir=%s,%s' % (lower_dir, upper_dir, work_dir, context),
+                requires=lower_dir
+            )
+            written.append(os.path.join(self.UNIT_DIR, container_unit))
+
+            dropin = self.nspawn_dropin(config)
+            if not os.path.isdir(os.path.dirname(dropin)):
+                os.makedirs(os.path.dirname(dropin))
+            written.append(dropin)
+            with open(dropin, 'w') as f:
+                f.write("[Unit]\nRequiresMountsFor=%s\n" % self.container_dir)
+            log.info("Wrote %s" % dropin)
+
+            subprocess.check_output(['systemctl', 'daemon-reload'])
+            subprocess.check_output(['systemctl', 'start', container_unit])
+        except BaseException:
+            self.remove_partial_overlay(config, written)
+            raise
+        log.info("Mounted %s over %s" % (self.container_dir, image))
+
+    def remove_partial_overlay(self, config, written):
+        """Undo a create_overlay() that failed part of the way through.  No phase completed, so no
+        checkpoint claims the container, and 'delete' must not find a writable layer for it either."""
+        for f in written:
+            try:
+                os.unlink(f)
+                log.info("Deleted %s" % f)
+            except OSError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(self.nspawn_dropin(config)))
+        except OSError:
+            pass
+
+        overlay_dir = self.overlay_dir(config)
+        if config['subvolume'] and os.path.exists(overlay_dir):
+            subprocess.check_output(['btrfs', 'subvolume', 'delete', overlay_dir])
+        elif os.path.isdir(overlay_dir):
+            shutil.rmtree(overlay_dir)
+        os.rmdir(self.container_dir)
+        if written:
+            subprocess.check_output(['systemctl', 'daemon-reload'])
+
+    def image_type(self, image):
+        """The filesystem of a base image according to blkid.  'salmon image --output' lets images have
+        any name, so the extension can't be trusted."""
+        try:
+            cmd = ['blkid', '-o', 'value', '-s', 'TYPE', image]
+            fs_type = subprocess.check_output(cmd, universal_newlines=True).strip()
+        except subprocess.CalledProcessError:
+            # blkid exits non-zero when it doesn't recognize anything
+            fs_type = None
+        if fs_type not in ImageCommand.FORMATS:
+            raise RuntimeError("Base image %s is not a %s image" % (image, " or ".join(ImageCommand.FORMATS)))
+        return fs_type
+
+    def write_mount_unit(self, where, what, fs_type, options, requires=None):
+        unit = self.mount_unit_name(where)
+        lines = ["[Unit]", "Description=Salmon mount for %s" % where]
+        if requires:
+            lines.append("RequiresMountsFor=%s" % requires)
+        lines.extend([
+            "",
+            "[Mount]",
+            "What=%s" % what,
+            "Where=%s" % where,
+            "Type=%s" % fs_type,
+            "Options=%s" % options,
+        ])
+
+        unit_file = os.path.join(self.UNIT_DIR, unit)
+        with open(unit_file, 'w') as f:
+            f.write("\n".join(lines))
+            f.write("\n")
+        log.info("Wrote %s" % unit_file)
+        return unit
+
     def post_creation(self, config):
-        self.fix_context()
-        self.remove_securetty(config)
+        if not config.get('base_image'):
+            self.run_phase('fix_context', self.fix_context)
+        self.run_phase('remove_securetty', self.remove_securetty, config)
         if config['root_password'] is not None:
-            self.set_root_password(config)
+            self.run_phase('set_root_password', self.set_root_password, config)
         if config['nspawn_file'] is not None:
-            self.create_nspawn_file(config)
+            self.run_phase('create_nspawn_file', self.create_nspawn_file, config)
+        if config.get('filesystem'):
+            with self.profiler.phase('filesystem_report'):
+                self.filesystem_report(config)
+
+    def build_dnf(self, config, filelists=None):
+        """Set up the repos and fill the sack.  filelists are by far the largest metadata most repos carry,
+        so unless the manifest asks for them they are only loaded when a package spec needs them."""
+        if filelists is None:
+            filelists = self.want_filelists(config)
+
+        with self.profiler.phase('load_repos'):
+            dnf_base = self.load_repos(config)
+
+        if hasattr(dnf_base.conf, 'optional_metadata_types'):
+            types = [t for t in dnf_base.conf.optional_metadata_types if t != 'filelists']
+            if filelists:
+                types.append('filelists')
+            dnf_base.conf.optional_metadata_types = types
+        else:
+            log.debug("This version of DNF cannot skip filelists")
+            filelists = True
+        self.filelists = filelists
+        log.debug("Loading filelists: %s" % filelists)
+
+        # Do not consider *anything* to be installed
+        with self.profiler.phase('fill_sack'):
+            dnf_base.fill_sack(load_system_repo=False, load_available_repos=True)
+
+        return dnf_base
 
-    def build_dnf(self, config):
+    def want_filelists(self, config):
+        setting = config.get('filelists', 'auto')
+        if setting != 'auto':
+            return setting
+        return any(p.startswith('/') and not self.PRIMARY_FILES_RE.match(p) for p in config['packages'])
+
+    def load_repos(self, config):
         dnf_base = dnf.Base()
 
         for repo in dnf_base.repos.all():
@@ -359,41 +934,185 @@ class BuildCommand(BaseCommand):
             repo = dnf.repo.Repo(repo_id, self.dnf_temp_cache)
             repo.enable()
             for opt, val in repo_opts.items():
-                # Inject is a custom option and DNF won't recognize it
-                if opt == "inject":
+                if opt in self.CUSTOM_REPO_OPTIONS:
                     continue
                 setattr(repo, opt, val)
 
-            repo.load()
+            # Setting these before the sack is filled keeps filtered packages out of the transaction
+            if 'include' in repo_opts:
+                repo.includepkgs = repo_opts['include']
+            if 'exclude' in repo_opts:
+                repo.excludepkgs = repo_opts['exclude']
+
+            if not self.bundle_dir and ('mirrors' in repo_opts or 'mirrorlists' in repo_opts):
+                repo.baseurl = self.rank_repo_mirrors(repo_id, repo_opts)
+
+            if self.bundle_dir:
+                # Everything comes from the bundle, but keep the definition around so that
+                # injected repos can still be written into the container.
+                repo.disable()
+            else:
+                repo.load()
             dnf_base.repos.add(repo)
             log.debug("Defined repo %s" % repo.id)
 
-        # Do not consider *anything* to be installed
-        dnf_base.fill_sack(load_system_repo=False, load_available_repos=True)
+        if self.bundle_dir:
+            for repo_id, repo_opts in sorted((self.bundle_repos or {self.BUNDLE_REPO_ID: {}}).items()):
+                repo = dnf.repo.Repo(repo_id, self.dnf_temp_cache)
+                repo.enable()
+                repo.baseurl = ['file://%s' % os.path.join(self.bundle_dir, repo_opts.get('path', '')).rstrip('/')]
+                if repo_opts.get('gpgcheck'):
+                    repo.gpgcheck = True
+                    repo.gpgkey = ['file://%s' % os.path.join(self.bundle_dir, k) for k in repo_opts.get('gpgkey', [])]
+                repo.load()
+                dnf_base.repos.add(repo)
+                log.debug("Defined bundle repo %s from %s" % (repo_id, self.config['bundle']))
 
         return dnf_base
 
-    def run_dnf(self, dnf_base, config):
-        dnf_base.conf.installroot = self.container_dir
-
+    def rank_repo_mirrors(self, repo_id, repo_opts):
+        """Probe every candidate baseurl for a repo and return the reachable ones, best first.  DNF
+        fails over between baseurls in order, and download() uses the same list."""
+        if repo_id in self.mirror_urls:
+            return self.mirror_urls[repo_id]
+
+        candidates = list(repo_opts.get('mirrors', []))
+        baseurl = repo_opts.get('baseurl', [])
+        candidates.extend([baseurl] if isinstance(baseurl, str) else baseurl)
+        for mirrorlist in repo_opts.get('mirrorlists', []):
+            candidates.extend(mirrors.expand_mirrorlist(mirrorlist))
+
+        ranked = [p.url for p in mirrors.rank_mirrors(candidates) if p.latency is not None]
+        if not ranked:
+            raise RuntimeError("None of the mirrors for repo %s are reachable" % repo_id)
+
+        log.info("Using mirrors for %s in the order %s" % (repo_id, ", ".join(ranked)))
+        self.mirror_urls[repo_id] = ranked
+        return ranked
+
+    def download(self, dnf_base, packages):
+        """Download packages from repos with ranked mirrors ourselves so that a slow or dropped mirror
+        fails over and a partial file resumes instead of starting from zero.  DNF verifies what is already
+        on disk and fetches anything that is left."""
+        jobs = []
+        for pkg in packages:
+            urls = self.mirror_urls.get(pkg.reponame)
+            dest = pkg.localPkg()
+            if not urls or os.path.exists(dest):
+                continue
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            jobs.append((["%s/%s" % (u.rstrip('/'), pkg.location) for u in urls], dest))
+
+        if jobs:
+            failed = mirrors.fetch_all(jobs)
+            log.info("Fetched %d of %d packages from ranked mirrors" % (len(jobs) - len(failed), len(jobs)))
+
+        dnf_base.download_packages(packages, Progress())
+
+    def check_signatures(self, dnf_base, packages):
+        """DNF's API leaves signature checks to its callers.  Check every package the way the dnf CLI does:
+        DNF skips packages from repos without gpgcheck, and a repo's gpgkey is imported into the
+        container's rpmdb the first time a package needs it."""
+        for pkg in packages:
+            code, message = dnf_base.package_signature_check(pkg)
+            if code == 1:
+                # The key isn't imported yet
+                dnf_base.package_import_key(pkg, askcb=lambda *args: True)
+                code, message = dnf_base.package_signature_check(pkg)
+            if code != 0:
+                raise RuntimeError("Signature check of %s failed: %s" % (pkg, message))
+
+    def unpack_bundle(self, config):
+        """Extract the bundle to a temporary directory and install the packages it records.  The
+        caller is responsible for removing the returned directory."""
+        bundle_dir = tempfile.mkdtemp(prefix="salmon_bundle_")
+        try:
+            with tarfile.open(config['bundle']) as tar:
+                tar.extractall(bundle_dir, members=self.bundle_members(tar, bundle_dir))
+        except (RuntimeError, tarfile.TarError):
+            shutil.rmtree(bundle_dir)
+            raise
+
+        with open(os.path.join(bundle_dir, self.BUNDLE_MANIFEST), 'r') as f:
+            bundle_manifest = yaml.safe_load(f)
+
+        config['packages'] = bundle_manifest['packages']
+        self.bundle_repos = bundle_manifest.get('repos')
+        log.info("Unpacked bundle %s" % config['bundle'])
+        return bundle_dir
+
+    def bundle_members(self, tar, bundle_dir):
+        """The members of a bundle, checked before anything is extracted.  A bundle only ever holds
+        regular files and directories, so links and devices are refused along with any path that would
+        land outside bundle_dir."""
+        root = os.path.realpath(bundle_dir)
+        members = tar.getmembers()
+        for member in members:
+            if not (member.isfile() or member.isdir()):
+                raise RuntimeError("Bundle %s contains %s, which is not a regular file" % (tar.name, member.name))
+            target = os.path.realpath(os.path.join(root, member.name))
+            if target != root and not target.startswith(root + os.sep):
+                raise RuntimeError("Bundle %s contains %s, which is outside the bundle" % (tar.name, member.name))
+        return members
+
+    def mark_packages(self, dnf_base, config):
+        """Mark the manifest's packages for installation.  Returns the package specs with
+        any URL replaced by the name of the RPM it points to."""
+        specs = []
         for p in config['packages']:
             try:
                 if '://' in p:
                     local_pkg = dnf_base.add_remote_rpm(p)
                     dnf_base.package_install(local_pkg, strict=True)
+                    specs.append(local_pkg.name)
                 else:
                     dnf_base.install(p)
+                    specs.append(p)
             except dnf.exceptions.Error:
                 log.exception("Could not install %s" % p)
                 sys.exit(1)
+        return specs
 
+    def resolve_packages(self, dnf_base):
+        """Depsolve and return the packages the transaction needs."""
         resolution = dnf_base.resolve()
-        if resolution:
-            to_fetch = [p.installed for p in dnf_base.transaction]
-            dnf_base.download_packages(to_fetch, Progress())
-            dnf_base.do_transaction()
-        else:
+        if not resolution:
             raise RuntimeError("DNF depsolving failed.")
+        return [p.installed for p in dnf_base.transaction]
+
+    def mark_and_resolve(self, dnf_base, config):
+        """Mark and depsolve the manifest's packages.  If that fails without filelists loaded, a file
+        dependency outside of primary.xml may be the cause, so try again with them.  Returns the DNF base
+        that was used, the package specs from mark_packages() and the packages to fetch."""
+        dnf_base.conf.installroot = self.container_dir
+        try:
+            with self.profiler.phase('resolve'):
+                specs = self.mark_packages(dnf_base, config)
+                return dnf_base, specs, self.resolve_packages(dnf_base)
+        except (RuntimeError, dnf.exceptions.Error):
+            if self.filelists or config.get('filelists', 'auto') != 'auto':
+                raise
+            log.info("Depsolving failed without filelists.  Loading them and trying again.")
+
+        dnf_base.close()
+        dnf_base = self.build_dnf(config, filelists=True)
+        dnf_base.conf.installroot = self.container_dir
+        with self.profiler.phase('resolve'):
+            specs = self.mark_packages(dnf_base, config)
+            return dnf_base, specs, self.resolve_packages(dnf_base)
+
+    def run_dnf(self, dnf_base, config):
+        """Install the manifest's packages and return the DNF base that was used."""
+        dnf_base, specs, to_fetch = self.mark_and_resolve(dnf_base, config)
+        # Kept in the checkpoint so a resumed build can still record what it installed
+        self.checkpoint.packages = sorted(str(p) for p in to_fetch)
+        with self.profiler.phase('download'):
+            self.download(dnf_base, to_fetch)
+            self.check_signatures(dnf_base, to_fetch)
+        with self.profiler.phase('transaction'):
+            dnf_base.do_transaction()
+        return dnf_base
 
     def post_dnf_run(self, dnf_base, config):
         injected_repos = [
@@ -402,6 +1121,9 @@ class BuildCommand(BaseCommand):
 
         output = ""
         for inj in injected_repos:
+            if self.bundle_dir:
+                # build_dnf() disables the manifest's repos for bundle builds
+                inj.enable()
             # dump() results in broken output since it creates lines with blank values that
             # DNF chokes on during a run.  Strip those out.
             output += "\n".join([o for o in inj.dump().split('\n') if not re.match(r"^\w+\s=\s*$", o)])
@@ -418,7 +1140,7 @@ class BuildCommand(BaseCommand):
         log.info("Fixing SELinux contexts")
         # Note that the (/.*)? is not interpreted by the shell, but by semanage-fcontext directly.
         subprocess.check_output([
-            'semanage', 'fcontext', '--add', '--type', 'svirt_sandbox_file_t', '%s(/.*)?' % self.container_dir
+            'semanage', 'fcontext', '--add', '--type', self.SELINUX_TYPE, '%s(/.*)?' % self.container_dir
         ])
         subprocess.check_output([
             'restorecon', '-R', self.container_dir
@@ -506,6 +1228,936 @@ class BuildCommand(BaseCommand):
         log.info("Wrote %s" % nspawn_file)
 
 
+class BundleCommand(BuildCommand):
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('bundle', help='export the RPMs a manifest needs to a local repo archive')
+        parser.add_argument(
+            "manifest",
+            nargs="?",
+            type=argparse.FileType('r'),
+            default=sys.stdin,
+            help="Manifest file"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--output",
+            help="Path to write the bundle to.  Defaults to NAME.bundle.tar in the current directory"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(BundleCommand, self).__init__(args)
+
+    def validate_subcommand_config(self, args, config, errors):
+        if args.output:
+            path = os.path.abspath(os.path.expanduser(args.output))
+        else:
+            path = os.path.abspath("%s.bundle.tar" % config.get('name', 'salmon'))
+
+        if os.access(os.path.dirname(path), os.W_OK):
+            config['bundle_output'] = path
+        else:
+            errors.append("Cannot write to directory %s" % os.path.dirname(path))
+
+        self.validate_metadata_config(config, errors)
+        return errors
+
+    def do_command(self):
+        self.dnf_temp_cache = tempfile.mkdtemp(prefix="salmon_dnf_cache_")
+        # Nothing is installed, but DNF still wants an installroot to resolve against
+        self.container_dir = tempfile.mkdtemp(prefix="salmon_bundle_root_")
+        bundle_dir = tempfile.mkdtemp(prefix="salmon_bundle_")
+
+        try:
+            dnf_base = self.build_dnf(self.config)
+            dnf_base, specs, to_fetch = self.mark_and_resolve(dnf_base, self.config)
+            with self.profiler.phase('download'):
+                self.download(dnf_base, to_fetch)
+            with self.profiler.phase('write_bundle'):
+                self.write_bundle(bundle_dir, to_fetch, specs, self.config)
+        finally:
+            for d in [self.dnf_temp_cache, self.container_dir, bundle_dir]:
+                shutil.rmtree(d)
+
+        log.info("Finished bundle for %s" % self.config['name'])
+        log.info("Peak memory use was %d KiB" % profiling.peak_rss())
+        return 0
+
+    def write_bundle(self, bundle_dir, packages, specs, config):
+        """Copy the downloaded packages into local repos, generate their metadata and pack everything
+        into a single tar archive.  RPM payloads are already compressed so the archive is not.
+
+        Packages from repos with gpgcheck set go into a repo that checks them against copies of those
+        repos' keys.  The rest, including packages given as URLs, go into one that doesn't, just as DNF
+        wouldn't have checked them."""
+        checked = set(repo_id for repo_id, opts in config['repos'].items() if is_true(opts.get('gpgcheck')))
+        bundle_repos = {}
+        for pkg in packages:
+            repo_id = self.BUNDLE_REPO_ID if pkg.reponame in checked else self.BUNDLE_UNCHECKED_REPO_ID
+            packages_dir = os.path.join(bundle_dir, repo_id, 'Packages')
+            if repo_id not in bundle_repos:
+                os.makedirs(packages_dir)
+                bundle_repos[repo_id] = {'path': repo_id}
+            shutil.copy(pkg.localPkg(), packages_dir)
+
+        if self.BUNDLE_REPO_ID in bundle_repos:
+            bundle_repos[self.BUNDLE_REPO_ID].update({
+                'gpgcheck': True,
+                'gpgkey': self.copy_gpgkeys(bundle_dir, config, sorted(checked)),
+            })
+
+        for repo_id in sorted(bundle_repos):
+            cmd = ['createrepo_c', os.path.join(bundle_dir, repo_id)]
+            output = subprocess.check_output(cmd)
+            log.info("%s returned %s" % (" ".join(cmd), output))
+
+        with open(os.path.join(bundle_dir, self.BUNDLE_MANIFEST), 'w') as f:
+            yaml.safe_dump(
+                {'name': config['name'], 'packages': specs, 'repos': bundle_repos}, f, default_flow_style=False
+            )
+
+        with tarfile.open(config['bundle_output'], 'w') as tar:
+            tar.add(bundle_dir, arcname='.')
+        log.info("Wrote %s" % config['bundle_output'])
+
+    def copy_gpgkeys(self, bundle_dir, config, repo_ids):
+        """Download the gpgkey files of the given repos into the bundle and return their paths in it"""
+        keys_dir = os.path.join(bundle_dir, 'keys')
+        os.mkdir(keys_dir)
+        keys = []
+        for repo_id in repo_ids:
+            urls = config['repos'][repo_id].get('gpgkey') or []
+            if not isinstance(urls, list):
+                # DNF accepts several keys separated by whitespace or commas
+                urls = re.split(r"[\s,]+", urls.strip())
+            for url in urls:
+                if not url or url in [k[0] for k in keys]:
+                    continue
+                path = os.path.join('keys', '%02d-%s' % (len(keys), os.path.basename(url)))
+                mirrors.fetch([url], os.path.join(bundle_dir, path))
+                log.info("Copied %s into the bundle" % url)
+                keys.append((url, path))
+        return [k[1] for k in keys]
+
+
+class ImageCommand(BaseCommand):
+    FORMATS = ['squashfs', 'erofs']
+
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('image', help='make a compressed read-only image from a built container')
+        parser.add_argument(
+            "manifest",
+            nargs="?",
+            type=argparse.FileType('r'),
+            default=sys.stdin,
+            help="Manifest file"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--format",
+            choices=cls.FORMATS,
+            default='squashfs',
+            help="Filesystem to use for the image"
+        )
+        parser.add_argument(
+            "--output",
+            help="Path to write the image to.  Defaults to NAME.FORMAT next to the container"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(ImageCommand, self).__init__(args)
+
+    def validate_subcommand_config(self, args, config, errors):
+        container_dir = os.path.join(config.get('destination', ''), config.get('name', ''))
+        if not os.path.isdir(container_dir):
+            errors.append("Container %s does not exist" % container_dir)
+
+        if args.output:
+            path = os.path.abspath(os.path.expanduser(args.output))
+        else:
+            path = "%s.%s" % (container_dir, args.format)
+
+        if os.path.exists(path):
+            errors.append("%s already exists" % path)
+        config['image_output'] = path
+        return errors
+
+    def do_command(self):
+        container_dir = os.path.join(self.config['destination'], self.config['name'])
+        output = self.config['image_output']
+
+        excludes = self.image_excludes(container_dir)
+        if self.args.format == 'erofs':
+            cmd = ['mkfs.erofs', '-zlz4hc'] + ['--exclude-path=%s' % e for e in excludes] + [output, container_dir]
+        else:
+            cmd = ['mksquashfs', container_dir, output, '-noappend']
+            if excludes:
+                # -e has to come last
+                cmd += ['-e'] + excludes
+
+        with self.profiler.phase('image'):
+            result = subprocess.check_output(cmd)
+        log.info("%s returned %s" % (" ".join(cmd), result))
+        log.info("Wrote %s" % output)
+        return 0
+
+    def image_excludes(self, container_dir):
+        """The nested subvolumes to leave out of the image, relative to the container, such as the
+        container's own /var/lib/machines.  Subvolumes the manifest's filesystem section declares hold
+        part of the container and are kept."""
+        filesystem = self.config.get('filesystem') or {}
+        declared = set(os.path.normpath(p).lstrip('/') for p, opts in filesystem.items() if opts.get('subvolume'))
+        excludes = []
+        for d in self.find_subvolumes(container_dir):
+            rel = os.path.relpath(d, container_dir)
+            if rel in declared:
+                log.info("Including subvolume /%s declared in the manifest" % rel)
+            else:
+                log.info("Leaving subvolume /%s out of the image" % rel)
+                excludes.append(rel)
+        return sorted(excludes)
+
+
+class BenchBootCommand(BaseCommand):
+    # machinectl only finds containers in these directories.  Containers elsewhere are booted
+    # with systemd-nspawn directly in a transient unit.
+    MACHINE_DIRS = ['/var/lib/machines', '/usr/local/lib/machines', '/usr/lib/machines']
+    POLL_INTERVAL = 0.1
+
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('bench-boot', help='measure how long a built container takes to boot')
+        parser.add_argument(
+            "manifest",
+            nargs="?",
+            type=argparse.FileType('r'),
+            default=sys.stdin,
+            help="Manifest file"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--runs",
+            type=int,
+            default=5,
+            help="Number of times to boot the container"
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=120,
+            help="Seconds to wait for the container to boot or shut down"
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            default=False,
+            help="Print the results as JSON"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(BenchBootCommand, self).__init__(args)
+
+    def validate_subcommand_config(self, args, config, errors):
+        container_dir = os.path.join(config.get('destination', ''), config.get('name', ''))
+        if not os.path.isdir(container_dir):
+            errors.append("Container %s does not exist" % container_dir)
+        if args.runs < 1:
+            errors.append("--runs must be at least 1")
+        return errors
+
+    def do_command(self):
+        self.container_dir = os.path.join(self.config['destination'], self.config['name'])
+        if self.machine_state() is not None:
+            raise RuntimeError("%s is already running" % self.config['name'])
+
+        results = []
+        for i in range(self.args.runs):
+            with self.profiler.phase('boot'):
+                result = self.boot_once()
+            log.info("Boot %d of %d: ready after %.3fs" % (i + 1, self.args.runs, result['ready']))
+            results.append(result)
+
+        report = self.summarize(results)
+        if self.args.json:
+            print(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self.print_report(report)
+        return 0
+
+    def boot_once(self):
+        """Boot the container, wait for it to finish starting up and collect systemd-analyze's view of the
+        boot from inside the container.  The container is always shut down again."""
+        start = monotonic()
+        self.start_container()
+        try:
+            self.wait_for(lambda: self.system_state() in ['running', 'degraded'], 'boot')
+            ready = monotonic() - start
+            if self.system_state() == 'degraded':
+                log.warning("%s booted with failed units" % self.config['name'])
+
+            analyze = self.run_in_container(['systemd-analyze', 'time'])
+            blame = self.run_in_container(['systemd-analyze', 'blame'])
+        finally:
+            self.stop_container()
+
+        return {
+            'ready': ready,
+            'multi_user': parse_multi_user(analyze),
+            'units': parse_blame(blame),
+        }
+
+    def start_container(self):
+        name = self.config['name']
+        if os.path.normpath(self.config['destination']) in self.MACHINE_DIRS:
+            cmd = ['machinectl', 'start', name]
+        else:
+            # systemd-nspawn reads /etc/systemd/nspawn/NAME.nspawn for a machine of that name either way.
+            # --collect unloads the unit even if it failed, e.g. after a terminate, so that the next boot
+            # can reuse its name.
+            cmd = [
+                'systemd-run', '--unit', 'salmon-bench-%s' % name, '--collect', '--property', 'KillMode=mixed',
+                'systemd-nspawn', '--quiet', '--boot', '--machine', name, '--directory', self.container_dir,
+            ]
+        subprocess.check_output(cmd)
+        log.debug("Started %s" % name)
+
+    def stop_container(self):
+        name = self.config['name']
+        try:
+            subprocess.check_output(['machinectl', 'poweroff', name])
+            self.wait_for(lambda: self.machine_state() is None, 'shutdown')
+        except (subprocess.CalledProcessError, RuntimeError):
+            log.warning("%s did not shut down cleanly.  Terminating it." % name)
+            subprocess.call(['machinectl', 'terminate', name])
+            self.wait_for(lambda: self.machine_state() is None, 'termination')
+
+    def wait_for(self, condition, what):
+        deadline = monotonic() + self.args.timeout
+        while not condition():
+            if monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for %s of %s" % (what, self.config['name']))
+            time.sleep(self.POLL_INTERVAL)
+
+    def machine_state(self):
+        """The machine's state according to machined, or None if it isn't registered"""
+        return self.query(['machinectl', 'show', '--property', 'State', '--value', self.config['name']])
+
+    def system_state(self):
+        """The output of is-system-running inside the container, or None if systemd there can't be reached yet"""
+        return self.query(['systemctl', '--machine', self.config['name'], 'is-system-running'])
+
+    def query(self, cmd):
+        # These commands report through their exit codes while the container is coming up or going down,
+        # so only output matters here
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        out, err = p.communicate()
+        return out.strip() or None
+
+    def run_in_container(self, cmd):
+        return subprocess.check_output(
+            ['systemd-run', '--machine', self.config['name'], '--quiet', '--wait', '--pipe'] + cmd,
+            universal_newlines=True
+        )
+
+    def summarize(self, results):
+        units = {}
+        for r in results:
+            for unit, seconds in r['units'].items():
+                units.setdefault(unit, []).append(seconds)
+
+        multi_user = [r['multi_user'] for r in results if r['multi_user'] is not None]
+        return {
+            'name': self.config['name'],
+            'runs': len(results),
+            'ready': percentiles([r['ready'] for r in results]),
+            'multi_user': percentiles(multi_user) if multi_user else None,
+            'units': dict((unit, percentiles(times)) for unit, times in units.items()),
+        }
+
+    def print_report(self, report, top=10):
+        print("%s: %d boots" % (report['name'], report['runs']))
+        rows = [('ready (host)', report['ready'])]
+        if report['multi_user']:
+            rows.append(('multi-user.target', report['multi_user']))
+        slowest = sorted(report['units'].items(), key=lambda u: u[1]['p50'], reverse=True)[:top]
+        rows.extend(slowest)
+
+        print("%-40s %9s %9s %9s %9s %9s" % ('', 'min', 'p50', 'p90', 'p99', 'max'))
+        for label, p in rows:
+            print("%-40s %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs" % (label, p['min'], p['p50'], p['p90'], p['p99'], p['max']))
+
+
+class DiffCommand(BaseCommand):
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('diff', help='list the files that differ between a container and another tree')
+        parser.add_argument(
+            "manifest",
+            nargs="?",
+            type=argparse.FileType('r'),
+            default=sys.stdin,
+            help="Manifest file"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--against",
+            required=True,
+            metavar="PATH",
+            help="Container or snapshot to compare the manifest's container with"
+        )
+        parser.add_argument(
+            "--scan",
+            action="store_true",
+            default=False,
+            help="Walk both trees even when they are related btrfs subvolumes"
+        )
+        parser.add_argument(
+            "--checksum",
+            action="store_true",
+            default=False,
+            help="When walking, hash files with matching sizes and mtimes instead of assuming they are the same"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of threads hashing files"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(DiffCommand, self).__init__(args)
+
+    def validate_subcommand_config(self, args, config, errors):
+        container_dir = os.path.join(config.get('destination', ''), config.get('name', ''))
+        if not os.path.isdir(container_dir):
+            errors.append("Container %s does not exist" % container_dir)
+
+        against = os.path.abspath(os.path.expanduser(args.against))
+        if not os.path.isdir(against):
+            errors.append("%s does not exist" % against)
+        config['against'] = against
+
+        if args.workers < 1:
+            errors.append("--workers must be at least 1")
+        return errors
+
+    def do_command(self):
+        """The container is the new side of the diff: files only in the container are added and files
+        only in the --against tree are deleted.  When one side is a btrfs snapshot of the other, an incremental
+        btrfs send between them narrows the comparison down to the paths that changed.  Otherwise both
+        trees are walked."""
+        container_dir = os.path.join(self.config['destination'], self.config['name'])
+        old = self.config['against']
+
+        result = None
+        with self.profiler.phase('diff'):
+            if not self.args.scan and diff.is_subvolume(old) and diff.is_subvolume(container_dir):
+                result = diff.send_diff(old, container_dir, self.args.workers)
+                if result is None:
+                    log.info("%s and %s are not snapshots of each other; walking both" % (old, container_dir))
+            method = 'send'
+            if result is None:
+                method = 'scan'
+                result = diff.scan_diff(old, container_dir, self.args.workers, self.args.checksum)
+
+        result['method'] = method
+        result['old'] = old
+        result['new'] = container_dir
+        log.info("%d added, %d modified, %d deleted" % (
+            len(result['added']), len(result['modified']), len(result['deleted'])
+        ))
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return 0
+
+
+class ListCommand(BaseCommand):
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('list', help='list the containers recorded in the inventory')
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--inventory",
+            metavar="DB",
+            help="SQLite inventory of built containers.  Defaults to %s" % inventory.DEFAULT_PATH
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            default=False,
+            help="Print the containers as JSON"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(ListCommand, self).__init__(args)
+
+    def run(self):
+        # Everything comes from the inventory, so there is no manifest to read
+        with self.profiler.phase('list'):
+            return self.do_command()
+
+    def validate_subcommand_config(self, args, config, errors):
+        return errors
+
+    def do_command(self):
+        containers = self.inventory.containers()
+        if self.args.json:
+            print(json.dumps(containers, indent=2, sort_keys=True))
+            return 0
+
+        print("%-30s %9s %10s  %-19s  %s" % ('NAME', 'PACKAGES', 'DISK', 'BUILT', 'PATH'))
+        for c in containers:
+            print("%-30s %9d %9.1fM  %-19s  %s" % (
+                c['name'], c['package_count'], (c['disk_size'] or 0) / 1048576.0, format_time(c['built']), c['path']
+            ))
+        return 0
+
+
+class ShowCommand(BaseCommand):
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('show', help='show what the inventory knows about a container')
+        parser.add_argument(
+            "container",
+            help="Name or path of the container"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--inventory",
+            metavar="DB",
+            help="SQLite inventory of built containers.  Defaults to %s" % inventory.DEFAULT_PATH
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            default=False,
+            help="Print the container as JSON"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(ShowCommand, self).__init__(args)
+
+    def run(self):
+        with self.profiler.phase('show'):
+            return self.do_command()
+
+    def validate_subcommand_config(self, args, config, errors):
+        return errors
+
+    def do_command(self):
+        found = self.inventory.find(self.args.container)
+        if not found:
+            raise RuntimeError("%s is not in the inventory %s" % (self.args.container, self.inventory.path))
+
+        if self.args.json:
+            print(json.dumps(found, indent=2, sort_keys=True))
+            return 0
+
+        for c in found:
+            print("%s" % c['path'])
+            print("  name:          %s" % c['name'])
+            print("  manifest hash: %s" % c['manifest_hash'])
+            print("  subvolume:     %s" % c['subvolume'])
+            if c['base_image']:
+                print("  base image:    %s" % c['base_image'])
+            print("  size:          %d bytes (%d on disk)" % (c['logical_size'] or 0, c['disk_size'] or 0))
+            print("  built:         %s" % format_time(c['built']))
+            print("  phases:")
+            for phase, seconds in c['phases']:
+                print("    %-20s %8.3fs" % (phase, seconds))
+            print("  packages (%d):" % len(c['packages']))
+            for nevra in c['packages']:
+                print("    %s" % nevra)
+        return 0
+
+
+class WatchCommand(BaseCommand):
+    # The form DNF prints packages in, which is how the inventory records them
+    NEVRA_FORMAT = '%{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH}\n'
+
+    @classmethod
+    def get_instance(cls, subparsers):
+        parser = subparsers.add_parser('watch', help='rebuild containers whose packages change upstream')
+        parser.add_argument(
+            "manifests",
+            nargs="+",
+            metavar="manifest",
+            help="Manifest files to watch"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Show extra output"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="DIR",
+            help="Write CPU and memory profiles for each phase of the command to DIR"
+        )
+        parser.add_argument(
+            "--inventory",
+            metavar="DB",
+            help="SQLite inventory of built containers.  Defaults to %s" % inventory.DEFAULT_PATH
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=300,
+            help="Seconds between polls of each repo"
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=2,
+            help="Number of rebuilds to run at once"
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Poll once, wait for the rebuilds that were queued and exit"
+        )
+        return cls
+
+    def __init__(self, args):
+        super(WatchCommand, self).__init__(args)
+        # The manifest hash and repo digests each manifest was last resolved and queued against
+        self.handled = {}
+        # Packages taken as installed in containers that predate the inventory and whose rpmdb can't be read
+        self.baselines = {}
+
+    def run(self):
+        # Manifests are loaded again on every poll so that edits are picked up
+        errors = self.validate_subcommand_config(self.args, {}, [])
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return self.do_command()
+
+    def validate_subcommand_config(self, args, config, errors):
+        if args.jobs < 1:
+            errors.append("--jobs must be at least 1")
+        if args.interval <= 0:
+            errors.append("--interval must be positive")
+        return errors
+
+    def do_command(self):
+        poller = watch.RepoPoller(self.args.interval)
+        builds = watch.BuildQueue(self.args.jobs)
+
+        while True:
+            start = time.time()
+            with self.profiler.phase('poll'):
+                self.poll(poller, builds, start)
+            if self.args.once:
+                builds.wait()
+                return 1 if builds.failed else 0
+            time.sleep(max(0, start + self.args.interval - time.time()))
+
+    def poll(self, poller, builds, now=None):
+        """Poll every repo the manifests use and queue rebuilds for the manifests whose resolved package
+        set no longer matches what the inventory recorded for their container.  A manifest is resolved
+        again whenever it or the metadata of one of its repos differs from when it was last handled, so a
+        manifest that was busy, couldn't be resolved or whose rebuild failed is retried on the next poll.
+        Returns the manifests that were queued."""
+        for path in builds.take_failed():
+            self.handled.pop(path, None)
+
+        builders = {}
+        keys = {}
+        always = set()
+        for path in self.args.manifests:
+            try:
+                builders[path] = self.load_manifest(path)
+            except (IOError, KeyError, RuntimeError, yaml.YAMLError) as e:
+                # validate_config() raises KeyError for some missing sections
+                log.error("Skipping %s: %s" % (path, e))
+                continue
+            if builders[path].config.get('base_image'):
+                # Its packages come from the image, not from the repos
+                log.error("Skipping %s: containers built on a base image can't be watched" % path)
+                del builders[path]
+                continue
+            keys[path] = set()
+            for repo_id, repo_opts in builders[path].config['repos'].items():
+                key = watch.repo_key(repo_opts)
+                if key is None:
+                    log.debug("Repo %s in %s can't be polled, so it is resolved every time" % (repo_id, path))
+                    always.add(path)
+                else:
+                    keys[path].add(key)
+
+        poller.changed(list(set().union(*keys.values())), now)
+
+        queued = []
+        for path in sorted(builders):
+            builder = builders[path]
+            digests = [poller.digests.get(repo) for repo in sorted(keys[path])]
+            if None in digests:
+                log.debug("Waiting for every repo of %s to answer" % path)
+                continue
+            state = (checkpoint.config_hash(builder.config), digests)
+            if path not in always and self.handled.get(path) == state:
+                continue
+            if builds.busy(path):
+                log.info("%s is being rebuilt; it will be resolved again on the next poll" % path)
+                continue
+
+            container_dir = os.path.abspath(os.path.join(builder.config['destination'], builder.config['name']))
+            try:
+                packages = self.resolve(builder)
+            except (RuntimeError, dnf.exceptions.Error, SystemExit) as e:
+                # mark_packages() exits when a package can't be found
+                log.error("Could not resolve %s: %s" % (path, e))
+                continue
+
+            baseline = self.baseline(container_dir, packages)
+            if baseline == packages:
+                log.info("Packages for %s are unchanged" % builder.config['name'])
+            else:
+                if baseline is None:
+                    log.info("%s hasn't been built; queueing a build" % builder.config['name'])
+                else:
+                    log.info("Packages for %s changed; queueing a rebuild" % builder.config['name'])
+                if not builds.submit(path, self.rebuild_commands(path, builder.config)):
+                    continue
+                queued.append(path)
+            self.handled[path] = state
+        return queued
+
+    def baseline(self, container_dir, packages):
+        """The packages the container at container_dir has, or None if there is no container.  They come
+        from the inventory, or for a container built before the inventory existed, from its rpmdb.  If
+        that can't be read either, packages is taken as the baseline, so the container is only rebuilt
+        once what it would install changes."""
+        recorded = [c for c in self.inventory.find(container_dir) if c['path'] == container_dir]
+        if recorded:
+            return recorded[0]['packages']
+        if not os.path.exists(container_dir):
+            return None
+
+        installed = self.installed_packages(container_dir)
+        if installed is None:
+            installed = self.baselines.setdefault(container_dir, packages)
+        return installed
+
+    def installed_packages(self, container_dir):
+        """The sorted NEVRAs in the container's rpmdb, or None if the host's rpm can't read it"""
+        cmd = ['rpm', '--root', container_dir, '-qa', '--qf', self.NEVRA_FORMAT]
+        try:
+            output = subprocess.check_output(cmd, universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("Could not read the rpmdb of %s: %s" % (container_dir, e))
+            return None
+        # Imported GPG keys show up as gpg-pubkey packages, which a transaction never installs
+        return sorted(line for line in output.splitlines() if line and not line.startswith('gpg-pubkey-'))
+
+    def load_manifest(self, path):
+        """Return a BuildCommand for the manifest at path with its config validated"""
+        parser = argparse.ArgumentParser()
+        BuildCommand.get_instance(parser.add_subparsers())
+        builder = BuildCommand(parser.parse_args(['build']))
+        with open(path, 'r') as f:
+            builder.config = builder.validate_config(yaml.safe_load(f))
+        return builder
+
+    def resolve(self, builder):
+        """The sorted NEVRAs a build of the manifest would install right now.  The DNF cache is thrown
+        away each time so that repo metadata is never stale."""
+        builder.dnf_temp_cache = tempfile.mkdtemp(prefix="salmon_dnf_cache_")
+        # Nothing is installed, but DNF still wants an installroot to resolve against
+        builder.container_dir = tempfile.mkdtemp(prefix="salmon_watch_root_")
+        try:
+            with self.profiler.phase('resolve'):
+                dnf_base = builder.build_dnf(builder.config)
+                dnf_base, specs, to_fetch = builder.mark_and_resolve(dnf_base, builder.config)
+                packages = sorted(str(p) for p in to_fetch)
+                dnf_base.close()
+        finally:
+            for d in [builder.dnf_temp_cache, builder.container_dir]:
+                shutil.rmtree(d)
+        return packages
+
+    def rebuild_commands(self, path, config):
+        """What the build queue runs for the manifest at path: a build, or when the container already
+        exists, replace_container()"""
+        container_dir = os.path.abspath(os.path.join(config['destination'], config['name']))
+        if os.path.exists(container_dir):
+            return [functools.partial(self.replace_container, path, config)]
+        return [self.build_command(path)]
+
+    def build_command(self, path):
+        return [sys.executable, '-m', 'salmon.main', 'build', path, '--inventory', self.inventory.path]
+
+    def replace_container(self, path, config):
+        """Rebuild an existing container without losing it if the build fails.  The old container is
+        renamed out of the way, which is cheap even for a subvolume, and only deleted once the new build
+        succeeded.  If the build fails, whatever it left behind is removed and the old container is put
+        back."""
+        container_dir = os.path.abspath(os.path.join(config['destination'], config['name']))
+        previous = os.path.join(os.path.dirname(container_dir), '.%s.salmon-previous' % config['name'])
+        os.rename(container_dir, previous)
+        try:
+            cmd = self.build_command(path)
+            log.info("Running %s" % " ".join(cmd))
+            subprocess.check_call(cmd)
+        except BaseException:
+            if os.path.exists(container_dir):
+                self.remove_container(config, container_dir)
+            if os.path.exists(self.checkpoint_path(config)):
+                self.load_deleter().delete_checkpoint(config)
+            os.rename(previous, container_dir)
+            log.info("Restored the previous %s" % container_dir)
+            raise
+        self.remove_container(config, previous)
+
+    def remove_container(self, config, container_dir):
+        if config['subvolume']:
+            self.load_deleter().delete_subvolumes(container_dir)
+        else:
+            shutil.rmtree(container_dir)
+        log.info("Deleted %s" % container_dir)
+
+    def load_deleter(self):
+        parser = argparse.ArgumentParser()
+        DeleteCommand.get_instance(parser.add_subparsers())
+        return DeleteCommand(parser.parse_args(['delete', '--inventory', self.inventory.path]))
+
+
+def monotonic():
+    # time.monotonic() is only available on Python 3
+    return getattr(time, 'monotonic', time.time)()
+
+
+TIMESPAN_RE = re.compile(r"([\d.]+)(h|min|ms|s|[^\d\s.]+s)")
+TIMESPAN_UNITS = {'h': 3600, 'min': 60, 's': 1, 'ms': 0.001}
+
+
+def parse_timespan(span):
+    """Convert a systemd timespan like '1min 2.345s' to seconds.  Anything ending in s that isn't
+    listed above is microseconds, which systemd writes as us or with a micro sign."""
+    return sum(float(value) * TIMESPAN_UNITS.get(unit, 0.000001) for value, unit in TIMESPAN_RE.findall(span))
+
+
+def parse_multi_user(analyze):
+    match = re.search(r"multi-user\.target reached after (.+?) in userspace", analyze)
+    return parse_timespan(match.group(1)) if match else None
+
+
+def parse_blame(blame):
+    units = {}
+    for line in blame.splitlines():
+        items = line.strip().rsplit(None, 1)
+        if len(items) == 2:
+            units[items[1]] = parse_timespan(items[0])
+    return units
+
+
+def percentiles(values):
+    """min, max and linearly interpolated 50th, 90th and 99th percentiles of values"""
+    ordered = sorted(values)
+
+    def pct(p):
+        k = (len(ordered) - 1) * p / 100.0
+        lower = int(k)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+    return {'min': ordered[0], 'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': ordered[-1]}
+
+
+def is_true(value):
+    """Whether a repo option like gpgcheck is on.  Manifests may give it as a boolean, a number or a
+    string, as in a .repo file."""
+    return str(value).lower() in ['1', 'true', 'yes', 'on']
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def disk_usage(path):
+    """Return the logical size and the allocated size of everything under path, counting hard links once"""
+    logical = 0
+    disk = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            st = os.lstat(os.path.join(root, f))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            logical += st.st_size
+            disk += st.st_blocks * 512
+    return logical, disk
+
+
 def main(args=None):
     logging.basicConfig(level=logging.DEBUG, format="%(levelname)5s [%(name)s:%(lineno)s] %(message)s")
     logger = logging.getLogger('')
@@ -0,0 +1,186 @@
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import socket
+import logging
+import threading
+import collections
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+    from httplib import HTTPException
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from http.client import HTTPException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10
+CHUNK_SIZE = 64 * 1024
+
+# Mirrors are ranked by the estimated time to fetch a file of this size, which weighs
+# latency against throughput roughly the way a typical RPM download would.
+RANK_SIZE = 1024 * 1024
+
+# repomd.xml is too small to say anything about throughput, so probes also read up to this much of
+# the primary metadata it points to.
+PROBE_SIZE = 256 * 1024
+PRIMARY_RE = re.compile(r'<data type="primary">.*?<location href="([^"]+)"', re.DOTALL)
+
+Probe = collections.namedtuple('Probe', ['url', 'latency', 'throughput'])
+
+
+def probe(url, timeout=DEFAULT_TIMEOUT):
+    """Measure a mirror.  Latency is the time until the headers for repomd.xml arrive and throughput
+    is measured over the first PROBE_SIZE bytes of the primary metadata.  Unreachable mirrors get a
+    latency and throughput of None."""
+    base = url.rstrip('/')
+    start = time.time()
+    try:
+        response = urlopen("%s/repodata/repomd.xml" % base, timeout=timeout)
+        latency = time.time() - start
+        repomd = response.read()
+
+        match = PRIMARY_RE.search(repomd.decode('utf-8', 'replace'))
+        if match:
+            request = Request("%s/%s" % (base, match.group(1)))
+            request.add_header('Range', 'bytes=0-%d' % (PROBE_SIZE - 1))
+            response = urlopen(request, timeout=timeout)
+        else:
+            log.debug("No primary metadata listed by %s; measuring throughput on repomd.xml" % url)
+            response = None
+
+        body_start = time.time()
+        # The server may ignore the range, so don't read more than we asked for
+        size = len(response.read(PROBE_SIZE)) if response else len(repomd)
+        body_time = time.time() - body_start
+    except (IOError, HTTPException) as e:
+        log.info("Mirror %s is unusable: %s" % (url, e))
+        return Probe(url, None, None)
+
+    # Guard against a zero duration on very fast local mirrors
+    return Probe(url, latency, size / max(body_time, 1e-6))
+
+
+def score(p):
+    if p.latency is None:
+        return float('inf')
+    return p.latency + RANK_SIZE / max(p.throughput, 1.0)
+
+
+def rank_mirrors(urls, timeout=DEFAULT_TIMEOUT):
+    """Probe every URL concurrently and return the probes ordered from best to worst.  Unreachable
+    mirrors sort last."""
+    results = [None] * len(urls)
+
+    def worker(i, url):
+        results[i] = probe(url, timeout)
+
+    threads = [threading.Thread(target=worker, args=(i, url)) for i, url in enumerate(urls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ranked = sorted(results, key=score)
+    for p in ranked:
+        if p.latency is not None:
+            log.debug("Mirror %s: latency %.3fs, throughput %d B/s" % (p.url, p.latency, p.throughput))
+    return ranked
+
+
+def expand_mirrorlist(url, timeout=DEFAULT_TIMEOUT):
+    """Return the baseurls listed in a plain text mirrorlist.  Metalinks are not supported."""
+    try:
+        response = urlopen(url, timeout=timeout)
+        lines = response.read().decode('utf-8').splitlines()
+    except (IOError, HTTPException) as e:
+        log.info("Could not read mirrorlist %s: %s" % (url, e))
+        return []
+    return [l.strip() for l in lines if l.strip() and not l.startswith('#')]
+
+
+def fetch(urls, dest, timeout=DEFAULT_TIMEOUT, rounds=3):
+    """Download a file to dest, trying each URL in order.  Data is written to dest.part so that when a
+    connection drops the next mirror can pick up where the last one stopped with a range request.
+    Every mirror is tried up to rounds times before giving up with an IOError."""
+    partial = "%s.part" % dest
+    for attempt in range(rounds):
+        for url in urls:
+            try:
+                fetch_one(url, partial, timeout)
+                os.rename(partial, dest)
+                return dest
+            except (IOError, HTTPException) as e:
+                log.info("Download of %s failed: %s" % (url, e))
+    raise IOError("Could not download %s from any mirror" % os.path.basename(dest))
+
+
+def fetch_one(url, partial, timeout=DEFAULT_TIMEOUT):
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 416:
+            # Whatever is on disk doesn't fit the file on the server.  Start over next time.
+            os.unlink(partial)
+        raise
+
+    if offset and response.getcode() != 206:
+        log.debug("%s ignored the range request; restarting" % url)
+        offset = 0
+
+    length = response.info().get('Content-Length')
+    expected = offset + int(length) if length is not None else None
+
+    written = 0
+    try:
+        with open(partial, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+    except socket.timeout:
+        raise IOError("Timed out reading %s after %d bytes" % (url, offset + written))
+
+    # A dropped connection can look like a normal end of file, so check the length ourselves
+    if expected is not None and offset + written < expected:
+        raise IOError("Connection to %s dropped after %d of %d bytes" % (url, offset + written, expected))
+
+
+def fetch_all(jobs, workers=4, timeout=DEFAULT_TIMEOUT):
+    """Run fetch() for each (urls, dest) pair in jobs with a pool of worker threads.  Returns the jobs
+    that could not be downloaded from any mirror."""
+    pending = list(jobs)
+    failed = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                urls, dest = pending.pop()
+            try:
+                fetch(urls, dest, timeout)
+                log.debug("Downloaded %s" % dest)
+            except IOError as e:
+                log.warning(str(e))
+                with lock:
+                    failed.append((urls, dest))
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(pending)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+
+import os
+import time
+import pstats
+import cProfile
+import logging
+import resource
+import collections
+
+from contextlib import contextmanager
+
+# tracemalloc is in the standard library from Python 3.4.  On Python 2 it is only available
+# from the pytracemalloc backport on a patched interpreter.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+# Collapsed stacks are written in microseconds and paths deeper than this are cut off
+MAX_DEPTH = 64
+
+
+def peak_rss():
+    """The high water mark of this process's resident memory in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_profiler(directory):
+    if directory:
+        return Profiler(directory)
+    return NullProfiler()
+
+
+class NullProfiler(object):
+    """Only times each phase.  timings maps phase names to seconds in the order the phases first ran,
+    with repeated phases added together."""
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        self.timings.setdefault(name, 0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, elapsed):
+        self.timings[name] = self.timings.get(name, 0) + elapsed
+
+
+class Profiler(NullProfiler):
+    """Profile each phase of a command.  For every phase, DIRECTORY receives NN-PHASE.prof (pstats),
+    NN-PHASE.folded (collapsed stacks for flamegraph.pl and similar tools), and when tracemalloc is
+    available NN-PHASE.tracemalloc (a snapshot taken at the end of the phase) and NN-PHASE.memory.txt
+    (the allocations that grew the most during the phase).  summary.txt gets one line per phase.
+
+    Phases must not be nested since only one cProfile profiler can be active at a time."""
+    def __init__(self, directory):
+        super(Profiler, self).__init__()
+        self.directory = directory
+        self.count = 0
+        self.active = None
+        self.started = False
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if tracemalloc is None:
+            log.warning("tracemalloc is not available.  Memory snapshots will not be written.")
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = True
+
+    @contextmanager
+    def phase(self, name):
+        if self.active:
+            log.debug("Not profiling %s separately since it runs inside %s" % (name, self.active))
+            with super(Profiler, self).phase(name):
+                yield
+            return
+
+        if not self.started:
+            self.start()
+
+        self.count += 1
+        self.active = name
+        self.timings.setdefault(name, 0)
+        prefix = os.path.join(self.directory, "%02d-%s" % (self.count, name))
+
+        start_snapshot = None
+        if tracemalloc is not None:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_snapshot = tracemalloc.take_snapshot()
+
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.time() - start
+            self.active = None
+            self.record(name, elapsed)
+            self.write_phase(name, prefix, profile, elapsed, start_snapshot)
+
+    def write_phase(self, name, prefix, profile, elapsed, start_snapshot):
+        profile.dump_stats("%s.prof" % prefix)
+        with open("%s.folded" % prefix, 'w') as f:
+            for stack, usec in sorted(collapse(pstats.Stats(profile).stats).items()):
+                f.write("%s %d\n" % (stack, usec))
+
+        python_peak = None
+        if start_snapshot is not None:
+            python_peak = tracemalloc.get_traced_memory()[1]
+            end_snapshot = tracemalloc.take_snapshot()
+            end_snapshot.dump("%s.tracemalloc" % prefix)
+            with open("%s.memory.txt" % prefix, 'w') as f:
+                for stat in end_snapshot.compare_to(start_snapshot, 'lineno')[:25]:
+                    f.write("%s\n" % stat)
+
+        # tracemalloc only sees Python allocations.  The process high water mark also covers
+        # memory libsolv and librepo use, e.g. while DNF fills the sack.
+        max_rss = peak_rss()
+        summary = "%s: %.3fs, python peak %s bytes, max RSS %d KiB" % (
+            name, elapsed, python_peak if python_peak is not None else "unknown", max_rss
+        )
+        with open(os.path.join(self.directory, 'summary.txt'), 'a') as f:
+            f.write("%s\n" % summary)
+        log.info("Profiled %s" % summary)
+
+
+def label(func):
+    filename, line, name = func
+    if filename == '~':
+        # Built-ins have no file
+        return name.replace(' ', '_')
+    return "%s:%d(%s)" % (os.path.basename(filename), line, name.replace(' ', '_'))
+
+
+def collapse(stats):
+    """Turn the caller/callee data pstats keeps into collapsed stacks mapping "a;b;c" to microseconds
+    spent in c itself.  cProfile doesn't record whole stacks, so time under a function reached from
+    several callers is split between them in proportion to each caller's share of its cumulative time."""
+    callees = collections.defaultdict(dict)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    stacks = collections.defaultdict(float)
+
+    def walk(func, path, seen, scale):
+        path = path + [label(func)]
+        stacks[";".join(path)] += stats[func][2] * scale * 1e6
+        if len(path) >= MAX_DEPTH:
+            return
+        for callee, edge in callees[func].items():
+            callee_ct = stats[callee][3]
+            # Skip recursion and anything too small to show up
+            if callee in seen or callee_ct <= 0:
+                continue
+            callee_scale = scale * edge[3] / callee_ct
+            if callee_ct * callee_scale * 1e6 < 1:
+                continue
+            walk(callee, path, seen | set([callee]), callee_scale)
+
+    for root in roots:
+        walk(root, [], set([root]), 1.0)
+
+    return dict((stack, int(round(usec))) for stack, usec in stacks.items() if usec >= 1)
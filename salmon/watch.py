@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+
+import re
+import time
+import hashlib
+import logging
+import threading
+import subprocess
+
+try:
+    from urllib2 import urlopen
+    from httplib import HTTPException
+    import Queue as queue
+except ImportError:
+    from urllib.request import urlopen
+    from http.client import HTTPException
+    import queue
+
+from salmon import mirrors
+
+log = logging.getLogger(__name__)
+
+REVISION_RE = re.compile(r"<revision>\s*([^<]*?)\s*</revision>")
+
+
+def repomd_revision(url, timeout=mirrors.DEFAULT_TIMEOUT):
+    """Fetch repomd.xml from a repo and return its <revision> (None if it has none) along with a digest
+    of the whole file.  The revision is only informational: createrepo_c defaults it to a timestamp with
+    one second resolution, so changes are detected with the digest."""
+    response = urlopen("%s/repodata/repomd.xml" % url.rstrip('/'), timeout=timeout)
+    repomd = response.read()
+    match = REVISION_RE.search(repomd.decode('utf-8', 'replace'))
+    return (match.group(1) if match else None), hashlib.sha256(repomd).hexdigest()
+
+
+def repo_key(repo_opts):
+    """Identify a repo by where its metadata comes from rather than by its ID, since manifests are free
+    to give the same repo different IDs.  Returns None for repos that can't be polled, e.g. ones that
+    only have a metalink."""
+    sources = []
+    for option in ['baseurl', 'mirrors', 'mirrorlists']:
+        value = repo_opts.get(option) or []
+        sources.extend((option, url) for url in (value if isinstance(value, list) else [value]))
+    if not sources:
+        return None
+    return tuple(sorted(sources))
+
+
+def repo_urls(key, timeout=mirrors.DEFAULT_TIMEOUT):
+    """The baseurls to poll for a repo_key(), with mirrorlists expanded"""
+    urls = []
+    for option, url in key:
+        if option == 'mirrorlists':
+            urls.extend(mirrors.expand_mirrorlist(url, timeout))
+        else:
+            urls.append(url)
+    return urls
+
+
+class RepoPoller(object):
+    """Remembers the last repomd.xml digest seen for each repo.  A repo is polled at most once per
+    interval however many manifests share it."""
+    def __init__(self, interval, timeout=mirrors.DEFAULT_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.digests = {}
+        self.polled = {}
+
+    def changed(self, keys, now=None):
+        """Poll the repos in keys that are due at now and return the ones whose metadata changed since they
+        were last polled.  A repo seen for the first time counts as changed.  If no mirror of a repo
+        answers, it is left alone until the next interval."""
+        changed = set()
+        now = now if now is not None else time.time()
+        for key in keys:
+            if key in self.polled and now - self.polled[key] < self.interval:
+                continue
+            self.polled[key] = now
+
+            digest = None
+            for url in repo_urls(key, self.timeout):
+                try:
+                    revision, digest = repomd_revision(url, self.timeout)
+                    log.debug("%s is at revision %s" % (url, revision))
+                    break
+                except (IOError, HTTPException) as e:
+                    log.info("Could not poll %s: %s" % (url, e))
+
+            if digest is None:
+                log.warning("No mirror of %s answered" % ", ".join(url for option, url in key))
+            elif self.digests.get(key) != digest:
+                self.digests[key] = digest
+                changed.add(key)
+        return changed
+
+
+class BuildQueue(object):
+    """Run commands for queued manifests on a fixed number of worker threads.  Each command is either an
+    argument list or a callable.  A manifest that is already queued or running is not queued again."""
+    def __init__(self, jobs):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.active = set()
+        self.failed = []
+        self.unclaimed = []
+        for i in range(jobs):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def submit(self, manifest, cmds):
+        with self.lock:
+            if manifest in self.active:
+                log.info("%s is already queued" % manifest)
+                return False
+            self.active.add(manifest)
+        self.queue.put((manifest, cmds))
+        return True
+
+    def busy(self, manifest):
+        with self.lock:
+            return manifest in self.active
+
+    def take_failed(self):
+        """The manifests whose rebuilds failed since the last call"""
+        with self.lock:
+            failed, self.unclaimed = self.unclaimed, []
+        return failed
+
+    def worker(self):
+        while True:
+            manifest, cmds = self.queue.get()
+            try:
+                for cmd in cmds:
+                    if callable(cmd):
+                        cmd()
+                    else:
+                        log.info("Running %s" % " ".join(cmd))
+                        subprocess.check_call(cmd)
+                log.info("Rebuilt %s" % manifest)
+            except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+                log.error("Rebuilding %s failed: %s" % (manifest, e))
+                with self.lock:
+                    self.failed.append(manifest)
+                    self.unclaimed.append(manifest)
+            finally:
+                with self.lock:
+                    self.active.discard(manifest)
+                self.queue.task_done()
+
+    def wait(self):
+        self.queue.join()
@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import textwrap
+
+import mock
+
+import salmon.diff as diff
+
+
+SUBVOLUME_SHOW = textwrap.dedent("""
+    containers/test
+    \tName: \t\t\ttest
+    \tUUID: \t\t\t%s
+    \tParent UUID: \t\t%s
+    \tCreation time: \t\t2016-08-10 12:00:00 -0400
+    \tGeneration: \t\t40
+    \tGen at creation: \t30
+""")
+
+# `btrfs receive --dump` output for the changes change_new() makes, plus a label change on
+# /etc/untouched and some metadata-only changes that never reach the parent directory's ctime
+RECEIVE_DUMP = textwrap.dedent("""
+    snapshot        ./new                           uuid=1f1c uuid transid=42 parent_uuid=0a0b parent_transid=30
+    utimes          ./new/                          atime=2016-08-10T12:00:00-0400 mtime=2016-08-10T12:00:00-0400
+    update_extent   ./new/etc/hostname              offset=0 len=3
+    mkfile          ./new/o259-42-0
+    rename          ./new/o259-42-0                 dest=./new/etc/added
+    update_extent   ./new/etc/added                 offset=0 len=5
+    unlink          ./new/var/lib/rpm/Packages
+    mkdir           ./new/o260-42-0
+    rename          ./new/o260-42-0                 dest=./new/opt
+    mkdir           ./new/opt/o261-42-0
+    rename          ./new/opt/o261-42-0             dest=./new/opt/app
+    mkfile          ./new/opt/app/o262-42-0
+    rename          ./new/opt/app/o262-42-0         dest=./new/opt/app/data
+    update_extent   ./new/opt/app/data              offset=0 len=4
+    chmod           ./new/etc/untouched/mode        mode=600
+    chown           ./new/etc/untouched/owner       gid=0 uid=1
+    truncate        ./new/etc/untouched/empty       size=0
+    set_xattr       ./new/etc/untouched             name=security.selinux data=system_u:object_r:etc_t:s0 len=26
+    update_extent   ./new/etc/with\\ space           offset=0 len=5
+""")
+
+
+class DiffTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_diff_")
+        self.old = os.path.join(self.work_dir, 'old')
+        self.new = os.path.join(self.work_dir, 'new')
+        for root in [self.old, self.new]:
+            os.makedirs(os.path.join(root, 'etc', 'untouched'))
+            os.makedirs(os.path.join(root, 'var', 'lib', 'rpm'))
+            self.write(root, 'etc/hostname', 'old')
+            self.write(root, 'etc/untouched/same', 'same')
+            self.write(root, 'var/lib/rpm/Packages', 'packages')
+            self.write(root, 'etc/untouched/mode', 'mode')
+            self.write(root, 'etc/untouched/owner', 'owner')
+            self.write(root, 'etc/untouched/empty', 'empty')
+            self.write(root, 'etc/with space', 'space')
+            os.symlink('hostname', os.path.join(root, 'etc', 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, root, path, content):
+        with open(os.path.join(root, path), 'w') as f:
+            f.write(content)
+
+    def change_new(self):
+        self.write(self.new, 'etc/hostname', 'new')
+        self.write(self.new, 'etc/added', 'added')
+        os.unlink(os.path.join(self.new, 'var', 'lib', 'rpm', 'Packages'))
+        os.makedirs(os.path.join(self.new, 'opt', 'app'))
+        self.write(self.new, 'opt/app/data', 'data')
+
+    def test_subvolume_info(self):
+        output = SUBVOLUME_SHOW % ('new-uuid', 'old-uuid')
+        with mock.patch('subprocess.check_output', return_value=output) as mock_subprocess:
+            info = diff.subvolume_info('/containers/test')
+        mock_subprocess.assert_called_with(['btrfs', 'subvolume', 'show', '/containers/test'], universal_newlines=True)
+        self.assertEqual({'uuid': 'new-uuid', 'parent_uuid': 'old-uuid'}, info)
+
+    def test_parse_dump(self):
+        touched = diff.parse_dump(RECEIVE_DUMP)
+        self.assertEqual(set(['utimes']), touched['/'])
+        self.assertEqual(set(['rename', 'update_extent']), touched['/etc/added'])
+        self.assertEqual(set(['mkfile', 'rename']), touched['/o259-42-0'])
+        self.assertEqual(set(['unlink']), touched['/var/lib/rpm/Packages'])
+        self.assertEqual(set(['chmod']), touched['/etc/untouched/mode'])
+        self.assertEqual(set(['chown']), touched['/etc/untouched/owner'])
+        self.assertEqual(set(['truncate']), touched['/etc/untouched/empty'])
+        self.assertEqual(set(['set_xattr']), touched['/etc/untouched'])
+        self.assertIn('/etc/with space', touched)
+        self.assertNotIn('/etc/untouched/same', touched)
+
+    def test_unescape(self):
+        self.assertEqual('a b\\c\nd\xe9', diff.unescape('a\\ b\\\\c\\nd\\351'))
+
+    def test_read_only_snapshot(self):
+        with mock.patch.object(diff, 'is_read_only', return_value=False), \
+            mock.patch('subprocess.check_output') as mock_subprocess:
+            with diff.read_only(self.new) as snapshot:
+                self.assertEqual(self.work_dir, os.path.dirname(os.path.dirname(snapshot)))
+                self.assertTrue(os.path.basename(os.path.dirname(snapshot)).startswith('.salmon-diff-'))
+                mock_subprocess.assert_called_with(['btrfs', 'subvolume', 'snapshot', '-r', self.new, snapshot])
+        mock_subprocess.assert_called_with(['btrfs', 'subvolume', 'delete', snapshot])
+        self.assertFalse(os.path.exists(os.path.dirname(snapshot)))
+
+        with mock.patch.object(diff, 'is_read_only', return_value=True):
+            with diff.read_only(self.new) as snapshot:
+                self.assertEqual(self.new, snapshot)
+
+    def test_scan_diff(self):
+        self.change_new()
+        result = diff.scan_diff(self.old, self.new)
+        self.assertEqual(['/etc/added', '/opt', '/opt/app', '/opt/app/data'], result['added'])
+        self.assertEqual(['/etc/hostname'], result['modified'])
+        self.assertEqual(['/var/lib/rpm/Packages'], result['deleted'])
+
+    def test_scan_diff_trusts_size_and_mtime(self):
+        self.write(self.new, 'etc/untouched/same', 'diff')
+        for root in [self.old, self.new]:
+            os.utime(os.path.join(root, 'etc', 'untouched', 'same'), (1470844800, 1470844800))
+
+        self.assertEqual([], diff.scan_diff(self.old, self.new)['modified'])
+        self.assertEqual(['/etc/untouched/same'], diff.scan_diff(self.old, self.new, checksum=True)['modified'])
+
+    def test_scan_diff_ignores_rewrites_with_same_content(self):
+        time.sleep(0.05)
+        self.write(self.new, 'etc/hostname', 'old')
+        self.assertEqual({'added': [], 'modified': [], 'deleted': []}, diff.scan_diff(self.old, self.new))
+
+    def send_diff(self, infos):
+        with mock.patch.object(diff, 'subvolume_info', side_effect=lambda p: infos[p]), \
+            mock.patch.object(diff, 'is_read_only', return_value=True), \
+            mock.patch.object(diff, 'send_stream', return_value=RECEIVE_DUMP) as mock_send:
+            result = diff.send_diff(self.old, self.new)
+        return result, mock_send
+
+    def test_send_diff(self):
+        self.change_new()
+        os.chmod(os.path.join(self.new, 'etc', 'untouched', 'mode'), 0o600)
+        self.write(self.new, 'etc/untouched/empty', '')
+        self.write(self.new, 'etc/with space', 'SPACE')
+        if os.geteuid() == 0:
+            os.lchown(os.path.join(self.new, 'etc', 'untouched', 'owner'), 1, 0)
+        # A change the stream doesn't mention isn't looked at
+        self.write(self.new, 'etc/untouched/same', 'diff')
+
+        result, mock_send = self.send_diff({
+            self.old: {'uuid': 'old-uuid', 'parent_uuid': None},
+            self.new: {'uuid': 'new-uuid', 'parent_uuid': 'old-uuid'},
+        })
+
+        mock_send.assert_called_with(self.old, self.new)
+        self.assertEqual(['/etc/added', '/opt', '/opt/app', '/opt/app/data'], result['added'])
+        expected = ['/etc/hostname', '/etc/untouched', '/etc/untouched/empty', '/etc/untouched/mode', '/etc/with space']
+        if os.geteuid() == 0:
+            expected.insert(4, '/etc/untouched/owner')
+        self.assertEqual(expected, result['modified'])
+        self.assertEqual(['/var/lib/rpm/Packages'], result['deleted'])
+
+    def test_send_diff_unrelated(self):
+        result, mock_send = self.send_diff({
+            self.old: {'uuid': 'old-uuid', 'parent_uuid': None},
+            self.new: {'uuid': 'new-uuid', 'parent_uuid': None},
+        })
+        self.assertIsNone(result)
+        self.assertFalse(mock_send.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
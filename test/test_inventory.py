@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import salmon.inventory as inventory
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_inventory_")
+        self.index = inventory.Inventory(os.path.join(self.work_dir, 'salmon', 'inventory.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.work_dir)
+
+    def container(self, path, **kwargs):
+        container = {
+            'path': path,
+            'name': os.path.basename(path),
+            'destination': os.path.dirname(path),
+            'manifest_hash': 'abc',
+            'subvolume': True,
+            'packages': ['bash-0:4.2.46-20.el7_2.x86_64'],
+            'phases': [('install', 10.0)],
+        }
+        container.update(kwargs)
+        return container
+
+    def test_creates_database(self):
+        self.assertEqual([], self.index.containers())
+        self.assertTrue(os.path.exists(self.index.path))
+
+    def test_rebuild_replaces_container(self):
+        self.index.record_build(self.container('/var/lib/machines/test'))
+        self.index.record_build(self.container(
+            '/var/lib/machines/test', manifest_hash='def', packages=['zsh-0:5.0.2-14.el7.x86_64', 'bash-0:4.2.46-20.el7_2.x86_64']
+        ))
+
+        found = self.index.find('test')
+        self.assertEqual(1, len(found))
+        self.assertEqual('def', found[0]['manifest_hash'])
+        self.assertEqual(['bash-0:4.2.46-20.el7_2.x86_64', 'zsh-0:5.0.2-14.el7.x86_64'], found[0]['packages'])
+        self.assertEqual([('install', 10.0)], found[0]['phases'])
+        self.assertEqual(['build', 'build'], [h['action'] for h in found[0]['history']])
+
+    def test_same_name_in_different_destinations(self):
+        self.index.record_build(self.container('/var/lib/machines/test'))
+        self.index.record_build(self.container('/srv/containers/test', subvolume=False))
+
+        self.assertEqual(['/srv/containers/test', '/var/lib/machines/test'], [c['path'] for c in self.index.containers()])
+        self.assertEqual(2, len(self.index.find('test')))
+        found = self.index.find('/srv/containers/test')
+        self.assertEqual(1, len(found))
+        self.assertFalse(found[0]['subvolume'])
+
+    def test_record_delete(self):
+        self.index.record_build(self.container('/var/lib/machines/test'))
+        self.index.record_build(self.container('/var/lib/machines/other'))
+        self.index.record_delete('/var/lib/machines/test', 'test')
+
+        self.assertEqual(['other'], [c['name'] for c in self.index.containers()])
+        self.assertEqual([], self.index.find('test'))
+        packages = self.index.conn.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+        self.assertEqual(1, packages)
+
+
+if __name__ == "__main__":
+    unittest.main()
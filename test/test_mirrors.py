@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import salmon.mirrors as mirrors
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+PAYLOAD = b"".join([("%06d" % i).encode('ascii') for i in range(50000)])
+REPOMD = b"""<repomd>
+  <data type="primary">
+    <location href="repodata/primary.xml.gz"/>
+  </data>
+</repomd>"""
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A mirror that serves PAYLOAD at /Packages/test.rpm and /repodata/primary.xml.gz.  It can be told
+    to respond slowly, drop the connection part of the way through, or ignore range requests."""
+    daemon_threads = True
+
+    def __init__(self, latency=0, drop_after=None, honor_range=True):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.drop_after = drop_after
+        self.honor_range = honor_range
+        self.ranges = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path == '/repodata/repomd.xml':
+            body = REPOMD
+        elif self.path in ['/Packages/test.rpm', '/repodata/primary.xml.gz']:
+            body = PAYLOAD
+        else:
+            self.send_error(404)
+            return
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get('Range', ''))
+        self.server.ranges.append(self.headers.get('Range'))
+        if match and self.server.honor_range:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        if self.server.drop_after is not None and body is PAYLOAD:
+            self.wfile.write(body[start:self.server.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+class MirrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_mirrors_")
+
+    def tearDown(self):
+        for s in self.servers:
+            s.shutdown()
+            s.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def start_server(self, **kwargs):
+        server = StandInServer(**kwargs)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.servers.append(server)
+        return server
+
+    def test_rank_mirrors(self):
+        slow = self.start_server(latency=0.3)
+        fast = self.start_server()
+        dead = "http://127.0.0.1:1"
+
+        ranked = mirrors.rank_mirrors([slow.url, dead, fast.url], timeout=2)
+        self.assertEqual([fast.url, slow.url, dead], [p.url for p in ranked])
+        self.assertIsNone(ranked[-1].latency)
+        self.assertEqual(['bytes=0-%d' % (mirrors.PROBE_SIZE - 1)], [r for r in fast.ranges if r])
+
+    def test_probes_run_concurrently(self):
+        servers = [self.start_server(latency=0.5) for i in range(4)]
+        start = time.time()
+        mirrors.rank_mirrors([s.url for s in servers], timeout=2)
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_fetch_resumes_on_next_mirror(self):
+        flaky = self.start_server(drop_after=100000)
+        good = self.start_server()
+        dest = os.path.join(self.work_dir, 'test.rpm')
+
+        mirrors.fetch(["%s/Packages/test.rpm" % s.url for s in [flaky, good]], dest, timeout=2)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(PAYLOAD, f.read())
+        self.assertEqual(['bytes=100000-'], good.ranges)
+        self.assertFalse(os.path.exists(dest + '.part'))
+
+    def test_fetch_restarts_without_range_support(self):
+        flaky = self.start_server(drop_after=100000)
+        no_range = self.start_server(honor_range=False)
+        dest = os.path.join(self.work_dir, 'test.rpm')
+
+        mirrors.fetch(["%s/Packages/test.rpm" % s.url for s in [flaky, no_range]], dest, timeout=2)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(PAYLOAD, f.read())
+
+    def test_fetch_fails_over_on_timeout(self):
+        stalled = self.start_server(latency=2)
+        good = self.start_server()
+        dest = os.path.join(self.work_dir, 'test.rpm')
+
+        mirrors.fetch(["%s/Packages/test.rpm" % s.url for s in [stalled, good]], dest, timeout=0.5)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(PAYLOAD, f.read())
+
+    def test_fetch_gives_up(self):
+        flaky = self.start_server(drop_after=100000, honor_range=False)
+        dest = os.path.join(self.work_dir, 'test.rpm')
+
+        with self.assertRaises(IOError):
+            mirrors.fetch(["%s/Packages/test.rpm" % flaky.url], dest, timeout=2, rounds=2)
+
+    def test_fetch_all(self):
+        good = self.start_server()
+        jobs = [
+            (["%s/Packages/test.rpm" % good.url], os.path.join(self.work_dir, 'a.rpm')),
+            (["%s/Packages/missing.rpm" % good.url], os.path.join(self.work_dir, 'b.rpm')),
+        ]
+        failed = mirrors.fetch_all(jobs, timeout=2)
+        self.assertEqual([jobs[1]], failed)
+        self.assertTrue(os.path.exists(jobs[0][1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
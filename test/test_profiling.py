@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import salmon.profiling as profiling
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_profile_")
+        self.profile_dir = os.path.join(self.work_dir, 'profile')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_null_profiler(self):
+        profiler = profiling.get_profiler(None)
+        with profiler.phase('nothing'):
+            pass
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_phase_writes_profiles(self):
+        profiler = profiling.get_profiler(self.profile_dir)
+        with profiler.phase('first'):
+            busy(10000)
+        with profiler.phase('second'):
+            busy(10000)
+
+        files = os.listdir(self.profile_dir)
+        for name in ['01-first', '02-second']:
+            self.assertIn('%s.prof' % name, files)
+            self.assertIn('%s.folded' % name, files)
+            if profiling.tracemalloc is not None:
+                self.assertIn('%s.tracemalloc' % name, files)
+                self.assertIn('%s.memory.txt' % name, files)
+
+        stats = pstats.Stats(os.path.join(self.profile_dir, '01-first.prof'))
+        self.assertIn('busy', [func[2] for func in stats.stats])
+
+        with open(os.path.join(self.profile_dir, '01-first.folded')) as f:
+            folded = f.read()
+        self.assertIn('test_profiling.py', folded)
+        for line in folded.splitlines():
+            stack, usec = line.rsplit(' ', 1)
+            self.assertTrue(int(usec) > 0)
+
+        with open(os.path.join(self.profile_dir, 'summary.txt')) as f:
+            summary = f.readlines()
+        self.assertEqual(2, len(summary))
+        self.assertTrue(summary[1].startswith('second:'))
+
+    def test_nested_phase_is_folded_into_outer(self):
+        profiler = profiling.get_profiler(self.profile_dir)
+        with profiler.phase('outer'):
+            with profiler.phase('inner'):
+                busy(1000)
+
+        self.assertEqual(['01-outer.folded'], [f for f in os.listdir(self.profile_dir) if f.endswith('.folded')])
+
+    def test_phases_are_timed(self):
+        for profiler in [profiling.get_profiler(None), profiling.get_profiler(self.profile_dir)]:
+            with profiler.phase('outer'):
+                with profiler.phase('inner'):
+                    busy(1000)
+            with profiler.phase('inner'):
+                busy(1000)
+
+            self.assertEqual(['outer', 'inner'], list(profiler.timings))
+            self.assertTrue(profiler.timings['outer'] > 0)
+            self.assertTrue(profiler.timings['inner'] > 0)
+
+    def test_collapse(self):
+        root = ('main.py', 1, 'main')
+        parse = ('main.py', 10, 'parse')
+        helper = ('util.py', 5, 'helper')
+        builtin = ('~', 0, "<method 'append' of 'list' objects>")
+        # func: (cc, nc, tt, ct, callers) with caller edges of (nc, cc, tt, ct)
+        stats = {
+            root: (1, 1, 0.001, 0.010, {}),
+            parse: (1, 1, 0.002, 0.006, {root: (1, 1, 0.002, 0.006)}),
+            helper: (2, 2, 0.004, 0.004, {root: (1, 1, 0.001, 0.001), parse: (1, 1, 0.003, 0.003)}),
+            builtin: (1, 1, 0.001, 0.001, {parse: (1, 1, 0.001, 0.001)}),
+        }
+
+        stacks = profiling.collapse(stats)
+        self.assertEqual({
+            'main.py:1(main)': 1000,
+            'main.py:1(main);main.py:10(parse)': 2000,
+            'main.py:1(main);util.py:5(helper)': 1000,
+            'main.py:1(main);main.py:10(parse);util.py:5(helper)': 3000,
+            "main.py:1(main);main.py:10(parse);<method_'append'_of_'list'_objects>": 1000,
+        }, stacks)
+
+    def test_collapse_handles_recursion(self):
+        root = ('main.py', 1, 'main')
+        recurse = ('main.py', 10, 'recurse')
+        stats = {
+            root: (1, 1, 0.001, 0.003, {}),
+            recurse: (1, 3, 0.002, 0.002, {root: (1, 1, 0.0, 0.002), recurse: (2, 0, 0.002, 0.002)}),
+        }
+
+        stacks = profiling.collapse(stats)
+        self.assertEqual(2, len(stacks))
+        self.assertEqual(2000, stacks['main.py:1(main);main.py:10(recurse)'])
+
+
+if __name__ == "__main__":
+    unittest.main()
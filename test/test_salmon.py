@@ -2,6 +2,9 @@
 from __future__ import absolute_import
 
 import os
+import sys
+import json
+import yaml
 import unittest
 import salmon.main as main
 import logging
@@ -10,8 +13,11 @@ import tempfile
 import mock
 import dnf
 import shutil
+import tarfile
 import crypt
 import textwrap
+import sqlite3
+import subprocess
 import StringIO
 
 from contextlib import contextmanager
@@ -21,6 +27,27 @@ logger = logging.getLogger('')
 logger.setLevel(logging.INFO)
 
 
+def setUpModule():
+    # Keep commands that record themselves from touching the real inventory
+    global inventory_dir, inventory_patch
+    inventory_dir = tempfile.mkdtemp(prefix="salmon_unit_test_inventory_")
+    inventory_patch = mock.patch.object(main.inventory, 'DEFAULT_PATH', os.path.join(inventory_dir, 'inventory.db'))
+    inventory_patch.start()
+
+
+def tearDownModule():
+    inventory_patch.stop()
+    shutil.rmtree(inventory_dir)
+
+
+def fake_systemd_escape(cmd, **kwargs):
+    if cmd[0] == 'systemd-escape':
+        return "%s.mount\n" % cmd[-1].strip('/').replace('/', '-')
+    if cmd[0] == 'blkid':
+        return "erofs\n"
+    return "OK"
+
+
 @contextmanager
 def open_mock(content=None, **kwargs):
     content_out = StringIO.StringIO()
@@ -128,6 +155,12 @@ class BuildCommandTest(unittest.TestCase):
         with self.assertRaises(SystemExit):
             main.Salmon(args)
 
+    def test_profile_option_on_every_subcommand(self):
+        for argv in [['build'], ['delete'], ['bundle'], ['image'], ['bench-boot'], ['diff', '--against', '/snapshot'], ['list'],
+                     ['show', 'test'], ['watch', 'test.yaml']]:
+            s = main.Salmon(argv + ['--profile', '/does/not/exist'])
+            self.assertIsInstance(getattr(s, argv[0].replace('-', '_')).profiler, main.profiling.Profiler)
+
     def test_root_password_options_mutually_exclusive(self):
         args = ['build', '--root-password', 'hello', '--no-root-password']
         with self.assertRaises(SystemExit):
@@ -204,6 +237,212 @@ class BuildCommandTest(unittest.TestCase):
         directory_name = os.path.join(self.good_config['destination'], self.good_config['name'])
         mock_mkdir.assert_called_with(directory_name)
 
+    def checkpoint_setup(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        self.good_config.update({
+            'destination': dest,
+            'subvolume': False,
+            'root_password': None,
+            'nspawn_file': None,
+        })
+        return dest
+
+    def write_checkpoint(self, cmd_instance, completed):
+        cache_dir = tempfile.mkdtemp(prefix="salmon_unit_test_dnf_cache_")
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        build_checkpoint = main.checkpoint.Checkpoint(cmd_instance.checkpoint_path(self.good_config))
+        build_checkpoint.completed = completed
+        build_checkpoint.cache_dir = cache_dir
+        build_checkpoint.manifest_hash = main.checkpoint.config_hash(cmd_instance.redact(self.good_config))
+        build_checkpoint.save()
+        return build_checkpoint
+
+    def test_failed_build_writes_checkpoint(self):
+        dest = self.checkpoint_setup()
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+
+        with mock.patch.object(main.BuildCommand, 'build_dnf'), \
+            mock.patch.object(main.BuildCommand, 'run_dnf'), \
+            mock.patch.object(main.BuildCommand, 'post_dnf_run'), \
+            mock.patch.object(main.BuildCommand, 'fix_context') as mock_fix:
+            mock_fix.side_effect = subprocess.CalledProcessError(1, 'restorecon')
+            with self.assertRaises(subprocess.CalledProcessError):
+                cmd_instance.do_command()
+
+        saved = main.checkpoint.Checkpoint(cmd_instance.checkpoint_path(self.good_config))
+        self.assertTrue(saved.exists())
+        saved.load()
+        self.addCleanup(shutil.rmtree, saved.cache_dir, True)
+        self.assertEqual(['create', 'install'], saved.completed)
+        self.assertTrue(os.path.isdir(saved.cache_dir))
+        self.assertTrue(os.path.isdir(os.path.join(dest, self.good_config['name'])))
+
+    def test_failure_before_creation_leaves_no_checkpoint(self):
+        dest = self.checkpoint_setup()
+        os.mkdir(os.path.join(dest, self.good_config['name']))
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+
+        with self.assertRaises(OSError):
+            cmd_instance.do_command()
+        self.assertFalse(os.path.exists(cmd_instance.checkpoint_path(self.good_config)))
+        self.assertFalse(os.path.exists(cmd_instance.dnf_temp_cache))
+
+    def test_checkpoint_requires_resume(self):
+        self.checkpoint_setup()
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+        saved = self.write_checkpoint(cmd_instance, ['create'])
+
+        with self.assertRaises(RuntimeError) as cm:
+            cmd_instance.do_command()
+        self.assertIn('--resume', str(cm.exception))
+        self.assertIn(saved.path, str(cm.exception))
+        self.assertIn(saved.cache_dir, str(cm.exception))
+
+    def test_resume_rejects_changed_manifest(self):
+        self.checkpoint_setup()
+        args = self.dummy_parser.parse_args(['build', '--resume'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+        self.write_checkpoint(cmd_instance, ['create'])
+        self.good_config['packages'].append('bash')
+
+        with self.assertRaisesRegexp(RuntimeError, 'manifest .* changed'):
+            cmd_instance.do_command()
+
+    def test_resume_skips_completed_phases(self):
+        self.checkpoint_setup()
+        args = self.dummy_parser.parse_args(['build', '--resume'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+        saved = self.write_checkpoint(cmd_instance, ['create', 'install', 'fix_context'])
+
+        with mock.patch.object(main.BuildCommand, 'build_dnf') as mock_build, \
+            mock.patch.object(main.BuildCommand, 'fix_context') as mock_fix, \
+            mock.patch.object(main.BuildCommand, 'remove_securetty') as mock_securetty:
+            cmd_instance.do_command()
+
+        self.assertFalse(mock_build.called)
+        self.assertFalse(mock_fix.called)
+        self.assertTrue(mock_securetty.called)
+        self.assertFalse(saved.exists())
+        self.assertFalse(os.path.exists(saved.cache_dir))
+
+    def test_finished_build_is_recorded(self):
+        dest = self.checkpoint_setup()
+        db = os.path.join(dest, 'inventory.db')
+        args = self.dummy_parser.parse_args(['build', '--resume', '--inventory', db])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+        saved = self.write_checkpoint(cmd_instance, ['create', 'install'])
+        saved.packages = ['bash-0:4.2.46-20.el7_2.x86_64', 'filesystem-0:3.2-20.el7.x86_64']
+        saved.save()
+        os.makedirs(os.path.join(dest, self.good_config['name'], 'etc'))
+        with open(os.path.join(dest, self.good_config['name'], 'etc', 'hostname'), 'w') as f:
+            f.write('salmon\n')
+
+        with mock.patch.object(main.BuildCommand, 'fix_context'), \
+            mock.patch.object(main.BuildCommand, 'remove_securetty'):
+            cmd_instance.do_command()
+
+        found = main.inventory.Inventory(db).find(self.good_config['name'])
+        self.assertEqual(1, len(found))
+        self.assertEqual(saved.packages, found[0]['packages'])
+        self.assertEqual(saved.manifest_hash, found[0]['manifest_hash'])
+        self.assertEqual(7, found[0]['logical_size'])
+        self.assertFalse(found[0]['subvolume'])
+        self.assertEqual(['fix_context', 'remove_securetty'], [p[0] for p in found[0]['phases']][:2])
+
+    def test_resume_reinstalls_after_failed_transaction(self):
+        dest = self.checkpoint_setup()
+        container_dir = os.path.join(dest, self.good_config['name'])
+        os.makedirs(os.path.join(container_dir, 'usr', 'bin'))
+        open(os.path.join(container_dir, 'half-written'), 'w').close()
+
+        args = self.dummy_parser.parse_args(['build', '--resume'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.good_config
+        saved = self.write_checkpoint(cmd_instance, ['create'])
+
+        def check_cache(*args):
+            self.assertEqual(saved.cache_dir, cmd_instance.dnf_temp_cache)
+            self.assertEqual([], os.listdir(container_dir))
+
+        with mock.patch.object(main.BuildCommand, 'build_dnf', side_effect=check_cache) as mock_build, \
+            mock.patch.object(main.BuildCommand, 'run_dnf'), \
+            mock.patch.object(main.BuildCommand, 'post_dnf_run'), \
+            mock.patch.object(main.BuildCommand, 'post_creation'):
+            cmd_instance.do_command()
+
+        self.assertTrue(mock_build.called)
+        self.assertTrue(os.path.isdir(container_dir))
+
+    def test_validate_filesystem(self):
+        args = self.dummy_parser.parse_args(['build'])
+        self.good_config['subvolume'] = False
+        self.good_config['filesystem'] = {
+            '/usr': {'compression': 'gzip'},
+            '/var/lib/*': {'cow': False},
+            'var/log': {'subvolume': True},
+            '/srv': {'dedupe': True},
+        }
+        with self.assertRaises(RuntimeError) as cm:
+            self.cmd_class(args).validate_config(self.good_config)
+
+        message = str(cm.exception)
+        self.assertIn('Compression for /usr', message)
+        self.assertIn('/var/lib/* cannot be a glob', message)
+        self.assertIn('var/log must be an absolute path', message)
+        self.assertIn('var/log can only be a subvolume', message)
+        self.assertIn('Unknown settings dedupe', message)
+
+    def test_apply_filesystem(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.container_dir = tempfile.mkdtemp(prefix="salmon_unit_test_container_")
+        self.addCleanup(shutil.rmtree, cmd_instance.container_dir)
+        self.good_config['filesystem'] = {
+            '/var/log/journal': {'cow': False},
+            '/usr': {'compression': 'zstd'},
+            '/var/log': {'subvolume': True},
+        }
+
+        with mock.patch('subprocess.check_output', return_value="OK") as mock_subprocess:
+            cmd_instance.apply_filesystem(self.good_config)
+
+        join = lambda p: os.path.join(cmd_instance.container_dir, p)
+        expected_calls = [
+            mock.call(['btrfs', 'property', 'set', join('usr'), 'compression', 'zstd']),
+            mock.call(['btrfs', 'subvolume', 'create', join('var/log')]),
+            mock.call(['chattr', '+C', join('var/log/journal')]),
+        ]
+        self.assertEqual(expected_calls, mock_subprocess.mock_calls)
+        self.assertTrue(os.path.isdir(join('usr')))
+        self.assertTrue(os.path.isdir(join('var')))
+
+    def test_filesystem_report_without_compsize(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.container_dir = tempfile.mkdtemp(prefix="salmon_unit_test_container_")
+        self.addCleanup(shutil.rmtree, cmd_instance.container_dir)
+        os.mkdir(os.path.join(cmd_instance.container_dir, 'usr'))
+        with open(os.path.join(cmd_instance.container_dir, 'usr', 'file'), 'w') as f:
+            f.write('x' * 1000)
+        os.link(os.path.join(cmd_instance.container_dir, 'usr', 'file'), os.path.join(cmd_instance.container_dir, 'link'))
+        self.good_config['filesystem'] = {'/usr': {'compression': 'zstd'}}
+
+        self.assertEqual(1000, main.disk_usage(cmd_instance.container_dir)[0])
+        with mock.patch('salmon.main.which', return_value=None), mock.patch.object(main.log, 'info') as mock_log:
+            cmd_instance.filesystem_report(self.good_config)
+        self.assertEqual(2, mock_log.call_count)
+        self.assertIn('1000 bytes logical', mock_log.call_args[0][0])
+
     def test_blanks_root_password(self):
         args = self.dummy_parser.parse_args(['build'])
         cmd_instance = self.cmd_class(args)
@@ -279,6 +518,884 @@ class BuildCommandTest(unittest.TestCase):
             cmd_instance.create_nspawn_file(self.good_config)
             self.assertEqual([], m.mock_calls)
 
+    def test_bundle_must_be_readable(self):
+        args = ['build', '--bundle', '/does/not/exist.tar']
+        s = main.Salmon(args)
+        with self.assertRaisesRegexp(RuntimeError, 'Cannot read bundle'):
+            s.build.validate_config(self.good_config)
+
+    def test_build_dnf_with_bundle(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.dnf_temp_cache = self.dnf_temp_cache
+        cmd_instance.bundle_dir = '/does/not/exist'
+        cmd_instance.config = self.good_config
+        self.good_config['bundle'] = '/does/not/exist.tar'
+
+        with mock.patch.object(dnf.repo.Repo, 'load') as mock_load, mock.patch.object(dnf.Base, 'fill_sack'):
+            dnf_base = cmd_instance.build_dnf(self.good_config)
+
+        enabled = [r.id for r in dnf_base.repos.all() if r.enabled]
+        self.assertEqual([self.cmd_class.BUNDLE_REPO_ID], enabled)
+        self.assertEqual(['file:///does/not/exist'], dnf_base.repos[self.cmd_class.BUNDLE_REPO_ID].baseurl)
+        # Only the bundle repo should have its metadata loaded
+        self.assertEqual(1, mock_load.call_count)
+
+    def test_build_dnf_with_signed_bundle(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.dnf_temp_cache = self.dnf_temp_cache
+        cmd_instance.bundle_dir = '/does/not/exist'
+        cmd_instance.bundle_repos = {
+            'salmon-bundle': {'path': 'salmon-bundle', 'gpgcheck': True, 'gpgkey': ['keys/00-RPM-GPG-KEY-test']},
+            'salmon-bundle-unchecked': {'path': 'salmon-bundle-unchecked'},
+        }
+        cmd_instance.config = self.good_config
+        self.good_config['bundle'] = '/does/not/exist.tar'
+
+        with mock.patch.object(dnf.repo.Repo, 'load'), mock.patch.object(dnf.Base, 'fill_sack'):
+            dnf_base = cmd_instance.build_dnf(self.good_config)
+
+        signed = dnf_base.repos['salmon-bundle']
+        self.assertEqual(['file:///does/not/exist/salmon-bundle'], signed.baseurl)
+        self.assertTrue(signed.gpgcheck)
+        self.assertEqual(['file:///does/not/exist/keys/00-RPM-GPG-KEY-test'], signed.gpgkey)
+        self.assertFalse(getattr(dnf_base.repos['salmon-bundle-unchecked'], 'gpgcheck', False))
+
+    def test_check_signatures(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['build']))
+        dnf_base = mock.Mock()
+        dnf_base.package_signature_check.side_effect = [(0, ''), (1, 'public key not installed'), (0, '')]
+        cmd_instance.check_signatures(dnf_base, ['signed', 'first-of-its-key'])
+        dnf_base.package_import_key.assert_called_once_with('first-of-its-key', askcb=mock.ANY)
+
+        dnf_base.package_signature_check.side_effect = [(2, 'bad signature')]
+        with self.assertRaisesRegexp(RuntimeError, 'bad signature'):
+            cmd_instance.check_signatures(dnf_base, ['tampered'])
+
+    def test_build_dnf_ranks_mirrors(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.dnf_temp_cache = self.dnf_temp_cache
+        self.good_config['repos']['centos_7_2']['mirrors'] = ['http://slow.example.com', 'http://fast.example.com']
+
+        ranked = [
+            main.mirrors.Probe('http://fast.example.com', 0.1, 1000),
+            main.mirrors.Probe('http://example.com', 0.2, 1000),
+            main.mirrors.Probe('http://slow.example.com', None, None),
+        ]
+        with mock.patch.object(dnf.repo.Repo, 'load'), mock.patch.object(dnf.Base, 'fill_sack'), \
+            mock.patch('salmon.mirrors.rank_mirrors', return_value=ranked) as mock_rank:
+            dnf_base = cmd_instance.build_dnf(self.good_config)
+
+        mock_rank.assert_called_once_with(['http://slow.example.com', 'http://fast.example.com', 'http://example.com'])
+        expected = ['http://fast.example.com', 'http://example.com']
+        self.assertEqual(expected, dnf_base.repos['centos_7_2'].baseurl)
+        self.assertEqual({'centos_7_2': expected}, cmd_instance.mirror_urls)
+
+    def test_build_dnf_filters_packages(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.dnf_temp_cache = self.dnf_temp_cache
+        self.good_config['repos']['centos_7_2']['include'] = ['systemd*', 'passwd']
+        self.good_config['repos']['external_repo_1']['exclude'] = ['kernel*']
+
+        with mock.patch.object(dnf.repo.Repo, 'load'), mock.patch.object(dnf.Base, 'fill_sack'):
+            dnf_base = cmd_instance.build_dnf(self.good_config)
+
+        self.assertEqual(['systemd*', 'passwd'], dnf_base.repos['centos_7_2'].includepkgs)
+        self.assertEqual(['kernel*'], dnf_base.repos['external_repo_1'].excludepkgs)
+        self.assertFalse(hasattr(dnf_base.repos['centos_7_2'], 'include'))
+
+    def test_filters_must_be_lists(self):
+        args = self.dummy_parser.parse_args(['build'])
+        self.good_config['repos']['centos_7_2']['exclude'] = 'kernel*'
+        with self.assertRaisesRegexp(RuntimeError, "'exclude' setting for repo centos_7_2"):
+            self.cmd_class(args).validate_config(self.good_config)
+
+    def test_want_filelists(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+
+        self.assertFalse(cmd_instance.want_filelists(self.good_config))
+        self.good_config['packages'].extend(['/usr/bin/vim', '/etc/passwd'])
+        self.assertFalse(cmd_instance.want_filelists(self.good_config))
+        self.good_config['packages'].append('/usr/share/man/man1/ls.1.gz')
+        self.assertTrue(cmd_instance.want_filelists(self.good_config))
+        self.good_config['filelists'] = False
+        self.assertFalse(cmd_instance.want_filelists(self.good_config))
+
+    def test_resolve_retries_with_filelists(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.container_dir = '/does/not/exist'
+        first_base = mock.Mock()
+        second_base = mock.Mock()
+
+        with mock.patch.object(main.BuildCommand, 'build_dnf', return_value=second_base) as mock_build, \
+            mock.patch.object(main.BuildCommand, 'mark_packages', return_value=['systemd']), \
+            mock.patch.object(main.BuildCommand, 'resolve_packages') as mock_resolve:
+            mock_resolve.side_effect = [RuntimeError("DNF depsolving failed."), ['systemd-219']]
+            result = cmd_instance.mark_and_resolve(first_base, self.good_config)
+
+        self.assertEqual((second_base, ['systemd'], ['systemd-219']), result)
+        mock_build.assert_called_once_with(self.good_config, filelists=True)
+        self.assertTrue(first_base.close.called)
+        self.assertEqual('/does/not/exist', second_base.conf.installroot)
+
+    def test_resolve_does_not_retry_with_filelists_loaded(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.container_dir = '/does/not/exist'
+        cmd_instance.filelists = True
+
+        with mock.patch.object(main.BuildCommand, 'mark_packages'), \
+            mock.patch.object(main.BuildCommand, 'resolve_packages', side_effect=RuntimeError("failed")):
+            with self.assertRaises(RuntimeError):
+                cmd_instance.mark_and_resolve(mock.Mock(), self.good_config)
+
+    def test_download_prefetches_from_mirrors(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.mirror_urls = {'centos_7_2': ['http://fast.example.com/', 'http://example.com']}
+
+        dest = os.path.join(self.dnf_temp_cache, 'centos_7_2', 'packages', 'vim-minimal.rpm')
+        mirrored = mock.NonCallableMock(reponame='centos_7_2', location='Packages/vim-minimal.rpm')
+        mirrored.localPkg.return_value = dest
+        unmirrored = mock.NonCallableMock(reponame='external_repo_1')
+        unmirrored.localPkg.return_value = os.path.join(self.dnf_temp_cache, 'other.rpm')
+        dnf_base = mock.Mock()
+
+        with mock.patch('salmon.mirrors.fetch_all', return_value=[]) as mock_fetch:
+            cmd_instance.download(dnf_base, [mirrored, unmirrored])
+
+        urls = ['http://fast.example.com/Packages/vim-minimal.rpm', 'http://example.com/Packages/vim-minimal.rpm']
+        mock_fetch.assert_called_once_with([(urls, dest)])
+        self.assertTrue(os.path.isdir(os.path.dirname(dest)))
+        self.assertTrue(dnf_base.download_packages.called)
+
+    def test_create_overlay(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        unit_dir = os.path.join(dest, 'units')
+        os.mkdir(unit_dir)
+
+        self.good_config.update({'destination': dest, 'subvolume': False, 'base_image': '/images/base.squashfs'})
+        cmd_instance.container_dir = os.path.join(dest, self.good_config['name'])
+
+        with mock.patch.object(self.cmd_class, 'UNIT_DIR', unit_dir), \
+            mock.patch('subprocess.check_output', side_effect=fake_systemd_escape) as mock_subprocess:
+            cmd_instance.create_overlay(self.good_config)
+
+        overlay_dir = os.path.join(dest, '.salmon-overlays', self.good_config['name'])
+        self.assertTrue(os.path.isdir(os.path.join(overlay_dir, 'upper')))
+        lower_dir = cmd_instance.image_mount_dir(self.good_config)
+        self.assertTrue(os.path.isdir(lower_dir))
+
+        container_unit = '%s.mount' % cmd_instance.container_dir.strip('/').replace('/', '-')
+        with open(os.path.join(unit_dir, container_unit)) as f:
+            unit = f.read()
+        self.assertIn('Type=overlay', unit)
+        self.assertIn('lowerdir=%s' % lower_dir, unit)
+        self.assertIn('upperdir=%s' % os.path.join(overlay_dir, 'upper'), unit)
+
+        # The image's type comes from blkid, not its .squashfs extension
+        with open(os.path.join(unit_dir, '%s.mount' % lower_dir.strip('/').replace('/', '-'))) as f:
+            self.assertIn('Type=erofs', f.read())
+
+        dropin = os.path.join(unit_dir, 'systemd-nspawn@CentOS_7_2-base.service.d', 'salmon-overlay.conf')
+        with open(dropin) as f:
+            self.assertIn('RequiresMountsFor=%s' % cmd_instance.container_dir, f.read())
+        self.assertIn(mock.call(['systemctl', 'start', container_unit]), mock_subprocess.mock_calls)
+
+    def test_create_overlay_over_existing_container(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['build']))
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        self.good_config.update({'destination': dest, 'subvolume': False, 'base_image': '/images/base.squashfs'})
+        cmd_instance.container_dir = os.path.join(dest, self.good_config['name'])
+        os.mkdir(cmd_instance.container_dir)
+
+        with mock.patch('subprocess.check_output', side_effect=fake_systemd_escape):
+            self.assertRaises(OSError, cmd_instance.create_overlay, self.good_config)
+        self.assertFalse(os.path.exists(cmd_instance.overlay_dir(self.good_config)))
+
+    def test_failed_overlay_is_removed(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['build']))
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        unit_dir = os.path.join(dest, 'units')
+        os.mkdir(unit_dir)
+        self.good_config.update({'destination': dest, 'subvolume': False, 'base_image': '/images/base.squashfs'})
+        cmd_instance.container_dir = os.path.join(dest, self.good_config['name'])
+
+        # Another container already uses the image, so its mount unit must survive
+        image_unit = '%s.mount' % cmd_instance.image_mount_dir(self.good_config).strip('/').replace('/', '-')
+        open(os.path.join(unit_dir, image_unit), 'w').close()
+
+        def fail_start(cmd, **kwargs):
+            if cmd[:2] == ['systemctl', 'start']:
+                raise subprocess.CalledProcessError(1, 'systemctl')
+            return fake_systemd_escape(cmd, **kwargs)
+
+        with mock.patch.object(self.cmd_class, 'UNIT_DIR', unit_dir), \
+            mock.patch('subprocess.check_output', side_effect=fail_start):
+            self.assertRaises(subprocess.CalledProcessError, cmd_instance.create_overlay, self.good_config)
+
+        self.assertEqual([image_unit], os.listdir(unit_dir))
+        self.assertFalse(os.path.exists(cmd_instance.overlay_dir(self.good_config)))
+        self.assertFalse(os.path.exists(cmd_instance.container_dir))
+
+    def test_unrecognized_base_image(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['build']))
+        with mock.patch('subprocess.check_output', return_value="ext4\n"):
+            self.assertRaises(RuntimeError, cmd_instance.image_type, '/images/base.squashfs')
+        with mock.patch('subprocess.check_output', side_effect=subprocess.CalledProcessError(2, 'blkid')):
+            self.assertRaises(RuntimeError, cmd_instance.image_type, '/images/base.squashfs')
+
+    def test_images_with_the_same_name_get_their_own_mounts(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['build']))
+        config = {'destination': '/var/lib/machines', 'base_image': '/images/a/base.squashfs'}
+        mount_dir = cmd_instance.image_mount_dir(config)
+        self.assertTrue(mount_dir.startswith('/var/lib/machines/.salmon-images/base-'))
+        config['base_image'] = '/images/b/base.squashfs'
+        self.assertNotEqual(mount_dir, cmd_instance.image_mount_dir(config))
+
+    def test_base_image_skips_relabel(self):
+        args = self.dummy_parser.parse_args(['build'])
+        cmd_instance = self.cmd_class(args)
+        self.good_config['base_image'] = '/images/base.squashfs'
+        self.good_config['root_password'] = None
+        self.good_config['nspawn_file'] = None
+        self.good_config['disable_securetty'] = False
+
+        with mock.patch.object(main.BuildCommand, 'fix_context') as mock_fix:
+            cmd_instance.post_creation(self.good_config)
+        self.assertFalse(mock_fix.called)
+
+
+class BundleCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        subparsers = self.dummy_parser.add_subparsers()
+        self.cmd_class = main.BundleCommand.get_instance(subparsers)
+        self.build_class = main.BuildCommand.get_instance(subparsers)
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_bundle_")
+        self.config = {
+            'name': 'CentOS_7_2-base',
+            'packages': ['systemd', 'https://example.com/epel-release-latest-7.noarch.rpm'],
+            'bundle_output': os.path.join(self.work_dir, 'out.bundle.tar'),
+            'repos': {
+                'base': {'baseurl': 'http://example.com', 'gpgcheck': 1, 'gpgkey': 'file://%s/RPM-GPG-KEY-test' % self.work_dir},
+                'other': {'baseurl': 'http://example.org', 'gpgcheck': 0},
+            },
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_test_bundle(self):
+        packages = []
+        for name, repo_id in [('systemd-219-19.el7.x86_64.rpm', 'base'), ('epel-release-7-8.noarch.rpm', '@commandline')]:
+            path = os.path.join(self.work_dir, name)
+            open(path, 'w').close()
+            packages.append(mock.NonCallableMock(localPkg=mock.Mock(return_value=path), reponame=repo_id))
+        with open(os.path.join(self.work_dir, 'RPM-GPG-KEY-test'), 'w') as f:
+            f.write("-----BEGIN PGP PUBLIC KEY BLOCK-----\n")
+
+        bundle_dir = os.path.join(self.work_dir, 'bundle')
+        os.mkdir(bundle_dir)
+        args = self.dummy_parser.parse_args(['bundle'])
+        with mock.patch('subprocess.check_output') as mock_subprocess:
+            mock_subprocess.return_value = "OK"
+            self.cmd_class(args).write_bundle(bundle_dir, packages, ['systemd', 'epel-release'], self.config)
+        self.assertEqual(
+            [mock.call(['createrepo_c', os.path.join(bundle_dir, r)]) for r in ['salmon-bundle', 'salmon-bundle-unchecked']],
+            mock_subprocess.call_args_list
+        )
+
+    def test_default_output(self):
+        args = self.dummy_parser.parse_args(['bundle'])
+        cmd_instance = self.cmd_class(args)
+        errors = cmd_instance.validate_subcommand_config(args, self.config, [])
+        self.assertEqual([], errors)
+        self.assertEqual(os.path.abspath('CentOS_7_2-base.bundle.tar'), self.config['bundle_output'])
+
+    def test_write_bundle(self):
+        self.write_test_bundle()
+
+        with tarfile.open(self.config['bundle_output']) as tar:
+            names = [os.path.normpath(n) for n in tar.getnames()]
+        # Packages given as URLs weren't checked by DNF, so they don't need a signature in the bundle either
+        self.assertIn('salmon-bundle/Packages/systemd-219-19.el7.x86_64.rpm', names)
+        self.assertIn('salmon-bundle-unchecked/Packages/epel-release-7-8.noarch.rpm', names)
+        self.assertIn('keys/00-RPM-GPG-KEY-test', names)
+        self.assertIn(self.cmd_class.BUNDLE_MANIFEST, names)
+
+    def test_unpack_bundle_replaces_packages(self):
+        self.write_test_bundle()
+
+        args = self.dummy_parser.parse_args(['build'])
+        build_config = {'bundle': self.config['bundle_output'], 'packages': self.config['packages']}
+        build_instance = self.build_class(args)
+        bundle_dir = build_instance.unpack_bundle(build_config)
+        try:
+            self.assertEqual(['systemd', 'epel-release'], build_config['packages'])
+            self.assertTrue(os.path.isdir(os.path.join(bundle_dir, 'salmon-bundle', 'Packages')))
+            self.assertEqual({
+                'salmon-bundle': {'path': 'salmon-bundle', 'gpgcheck': True, 'gpgkey': ['keys/00-RPM-GPG-KEY-test']},
+                'salmon-bundle-unchecked': {'path': 'salmon-bundle-unchecked'},
+            }, build_instance.bundle_repos)
+        finally:
+            shutil.rmtree(bundle_dir)
+
+    def test_unpack_bundle_refuses_unsafe_members(self):
+        args = self.dummy_parser.parse_args(['build'])
+        manifest = os.path.join(self.work_dir, 'manifest.yaml')
+        with open(manifest, 'w') as f:
+            f.write("packages: [bash]\n")
+
+        for name, kind in [('../escaped', tarfile.REGTYPE), ('/etc/escaped', tarfile.REGTYPE), ('link', tarfile.SYMTYPE)]:
+            bundle = os.path.join(self.work_dir, 'unsafe.tar')
+            with tarfile.open(bundle, 'w') as tar:
+                tar.add(manifest, arcname=self.cmd_class.BUNDLE_MANIFEST)
+                member = tarfile.TarInfo(name)
+                member.type = kind
+                member.linkname = '/etc/passwd'
+                tar.addfile(member)
+
+            build_config = {'bundle': bundle, 'packages': []}
+            with mock.patch('tempfile.mkdtemp', return_value=os.path.join(self.work_dir, 'extracted')):
+                os.mkdir(os.path.join(self.work_dir, 'extracted'))
+                self.assertRaises(RuntimeError, self.build_class(args).unpack_bundle, build_config)
+            self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'extracted')))
+            self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'escaped')))
+
+
+class ImageCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        self.cmd_class = main.ImageCommand.get_instance(self.dummy_parser.add_subparsers())
+        self.dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        os.mkdir(os.path.join(self.dest, 'CentOS_7_2-base'))
+        self.config = {'destination': self.dest, 'name': 'CentOS_7_2-base'}
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def run_image(self, argv):
+        args = self.dummy_parser.parse_args(argv)
+        cmd_instance = self.cmd_class(args)
+        self.assertEqual([], cmd_instance.validate_subcommand_config(args, self.config, []))
+        cmd_instance.config = self.config
+        with mock.patch('subprocess.check_output') as mock_subprocess:
+            mock_subprocess.return_value = "OK"
+            cmd_instance.do_command()
+        return mock_subprocess
+
+    def test_squashfs_image(self):
+        mock_subprocess = self.run_image(['image'])
+        container_dir = os.path.join(self.dest, 'CentOS_7_2-base')
+        mock_subprocess.assert_called_with(['mksquashfs', container_dir, container_dir + '.squashfs', '-noappend'])
+
+    def test_declared_subvolumes_are_included(self):
+        container_dir = os.path.join(self.dest, 'CentOS_7_2-base')
+        subvolumes = [os.path.join(container_dir, p) for p in ['var/lib/machines', 'var/lib/mysql', 'var/log']]
+        self.config['filesystem'] = {'/var/lib/mysql': {'subvolume': True, 'cow': False}, '/var/log/': {'subvolume': True}}
+
+        with mock.patch.object(self.cmd_class, 'find_subvolumes', return_value=subvolumes):
+            mock_subprocess = self.run_image(['image'])
+        mock_subprocess.assert_called_with(
+            ['mksquashfs', container_dir, container_dir + '.squashfs', '-noappend', '-e', 'var/lib/machines']
+        )
+
+    def test_erofs_image(self):
+        mock_subprocess = self.run_image(['image', '--format', 'erofs', '--output', '/does/not/exist.img'])
+        container_dir = os.path.join(self.dest, 'CentOS_7_2-base')
+        mock_subprocess.assert_called_with(['mkfs.erofs', '-zlz4hc', '/does/not/exist.img', container_dir])
+
+    def test_erofs_image_skips_nested_subvolumes(self):
+        container_dir = os.path.join(self.dest, 'CentOS_7_2-base')
+        subvolume = os.path.join(container_dir, 'var', 'lib', 'machines')
+        with mock.patch.object(self.cmd_class, 'find_subvolumes', return_value=[subvolume]):
+            mock_subprocess = self.run_image(['image', '--format', 'erofs'])
+        mock_subprocess.assert_called_with(
+            ['mkfs.erofs', '-zlz4hc', '--exclude-path=var/lib/machines', container_dir + '.erofs', container_dir]
+        )
+
+    def test_missing_container(self):
+        args = self.dummy_parser.parse_args(['image'])
+        self.config['name'] = 'missing'
+        errors = self.cmd_class(args).validate_subcommand_config(args, self.config, [])
+        self.assertIn('does not exist', errors[0])
+
+
+class BenchBootCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        self.cmd_class = main.BenchBootCommand.get_instance(self.dummy_parser.add_subparsers())
+        self.config = {'destination': '/var/lib/machines', 'name': 'CentOS_7_2-base'}
+
+        self.analyze = textwrap.dedent("""
+        Startup finished in 1.201s (userspace)
+        multi-user.target reached after 1.1s in userspace
+        """)
+        self.blame = textwrap.dedent("""
+                  1min 2.5s dnf-makecache.service
+                      512ms systemd-journald.service
+                      250us systemd-tmpfiles-setup.service
+        """)
+
+    def test_salmon_dispatches_dashed_subcommand(self):
+        s = main.Salmon(['bench-boot', '--runs', '3'])
+        with mock.patch.object(main.BenchBootCommand, 'run') as mock_run:
+            s.run()
+        self.assertTrue(mock_run.called)
+        self.assertEqual(3, s.bench_boot.args.runs)
+
+    def test_parse_timespan(self):
+        self.assertAlmostEqual(62.345, main.parse_timespan('1min 2.345s'))
+        self.assertAlmostEqual(0.512, main.parse_timespan('512ms'))
+        self.assertAlmostEqual(0.00025, main.parse_timespan('250us'))
+        self.assertAlmostEqual(3600.5, main.parse_timespan('1h 500ms'))
+
+    def test_parse_analyze_output(self):
+        self.assertAlmostEqual(1.1, main.parse_multi_user(self.analyze))
+        self.assertIsNone(main.parse_multi_user('Bootup is not yet finished.'))
+
+        units = main.parse_blame(self.blame)
+        self.assertEqual(3, len(units))
+        self.assertAlmostEqual(62.5, units['dnf-makecache.service'])
+        self.assertAlmostEqual(0.512, units['systemd-journald.service'])
+
+    def test_percentiles(self):
+        p = main.percentiles([5, 1, 4, 2, 3])
+        self.assertEqual(1, p['min'])
+        self.assertEqual(3, p['p50'])
+        self.assertAlmostEqual(4.6, p['p90'])
+        self.assertAlmostEqual(4.96, p['p99'])
+        self.assertEqual(5, p['max'])
+        self.assertEqual(7, main.percentiles([7])['p99'])
+
+    def test_boot_once(self):
+        args = self.dummy_parser.parse_args(['bench-boot'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.config
+
+        states = iter([None, 'starting', 'running', 'running'])
+        with mock.patch.object(self.cmd_class, 'start_container') as mock_start, \
+            mock.patch.object(self.cmd_class, 'stop_container') as mock_stop, \
+            mock.patch.object(self.cmd_class, 'system_state', side_effect=lambda: next(states)), \
+            mock.patch.object(self.cmd_class, 'run_in_container', side_effect=[self.analyze, self.blame]), \
+            mock.patch.object(self.cmd_class, 'POLL_INTERVAL', 0):
+            result = cmd_instance.boot_once()
+
+        self.assertTrue(mock_start.called)
+        self.assertTrue(mock_stop.called)
+        self.assertAlmostEqual(1.1, result['multi_user'])
+        self.assertIn('systemd-journald.service', result['units'])
+
+    def test_boot_once_stops_container_on_timeout(self):
+        args = self.dummy_parser.parse_args(['bench-boot', '--timeout', '0'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.config
+
+        with mock.patch.object(self.cmd_class, 'start_container'), \
+            mock.patch.object(self.cmd_class, 'stop_container') as mock_stop, \
+            mock.patch.object(self.cmd_class, 'system_state', return_value='starting'):
+            with self.assertRaisesRegexp(RuntimeError, 'Timed out'):
+                cmd_instance.boot_once()
+        self.assertTrue(mock_stop.called)
+
+    def test_start_container_outside_machines_dir(self):
+        args = self.dummy_parser.parse_args(['bench-boot'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': '/srv/containers', 'name': 'test'}
+        cmd_instance.container_dir = '/srv/containers/test'
+
+        with mock.patch('subprocess.check_output') as mock_subprocess:
+            cmd_instance.start_container()
+        cmd = mock_subprocess.call_args[0][0]
+        self.assertEqual('systemd-run', cmd[0])
+        self.assertIn('--collect', cmd)
+        self.assertIn('/srv/containers/test', cmd)
+
+        cmd_instance.config = self.config
+        with mock.patch('subprocess.check_output') as mock_subprocess:
+            cmd_instance.start_container()
+        mock_subprocess.assert_called_with(['machinectl', 'start', 'CentOS_7_2-base'])
+
+    def test_summarize(self):
+        args = self.dummy_parser.parse_args(['bench-boot'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = self.config
+        results = [
+            {'ready': 2.0, 'multi_user': 1.5, 'units': {'a.service': 1.0}},
+            {'ready': 3.0, 'multi_user': None, 'units': {'a.service': 2.0, 'b.service': 0.5}},
+        ]
+
+        report = cmd_instance.summarize(results)
+        self.assertEqual(2, report['runs'])
+        self.assertEqual(2.5, report['ready']['p50'])
+        self.assertEqual(1.5, report['multi_user']['max'])
+        self.assertEqual(1.5, report['units']['a.service']['p50'])
+        self.assertEqual(0.5, report['units']['b.service']['p50'])
+
+
+class DiffCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        self.cmd_class = main.DiffCommand.get_instance(self.dummy_parser.add_subparsers())
+        self.dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.container_dir = os.path.join(self.dest, 'CentOS_7_2-base')
+        self.snapshot_dir = os.path.join(self.dest, 'CentOS_7_2-base.snapshot')
+        os.mkdir(self.container_dir)
+        os.mkdir(self.snapshot_dir)
+        self.config = {'destination': self.dest, 'name': 'CentOS_7_2-base'}
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def run_diff(self, argv):
+        args = self.dummy_parser.parse_args(argv)
+        cmd_instance = self.cmd_class(args)
+        self.assertEqual([], cmd_instance.validate_subcommand_config(args, self.config, []))
+        cmd_instance.config = self.config
+        cmd_instance.do_command()
+
+    def test_missing_against(self):
+        args = self.dummy_parser.parse_args(['diff', '--against', os.path.join(self.dest, 'missing')])
+        errors = self.cmd_class(args).validate_subcommand_config(args, self.config, [])
+        self.assertIn('does not exist', errors[0])
+
+    def test_snapshots_use_send_stream(self):
+        result = {'added': [], 'modified': ['/etc/hostname'], 'deleted': []}
+        with mock.patch('salmon.diff.is_subvolume', return_value=True), \
+            mock.patch('salmon.diff.send_diff', return_value=result) as mock_send, \
+            mock.patch('salmon.diff.scan_diff') as mock_scan:
+            self.run_diff(['diff', '--against', self.snapshot_dir])
+        mock_send.assert_called_with(self.snapshot_dir, self.container_dir, 4)
+        self.assertFalse(mock_scan.called)
+        self.assertEqual('send', result['method'])
+
+    def test_unrelated_subvolumes_fall_back_to_scan(self):
+        result = {'added': [], 'modified': [], 'deleted': []}
+        with mock.patch('salmon.diff.is_subvolume', return_value=True), \
+            mock.patch('salmon.diff.send_diff', return_value=None), \
+            mock.patch('salmon.diff.scan_diff', return_value=result) as mock_scan:
+            self.run_diff(['diff', '--against', self.snapshot_dir, '--checksum', '--workers', '8'])
+        mock_scan.assert_called_with(self.snapshot_dir, self.container_dir, 8, True)
+        self.assertEqual('scan', result['method'])
+
+    def test_directories_are_scanned(self):
+        with mock.patch('salmon.diff.send_diff') as mock_send:
+            self.run_diff(['diff', '--against', self.snapshot_dir])
+        self.assertFalse(mock_send.called)
+
+
+class InventoryCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        subparsers = self.dummy_parser.add_subparsers()
+        self.list_class = main.ListCommand.get_instance(subparsers)
+        self.show_class = main.ShowCommand.get_instance(subparsers)
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_inventory_")
+        self.db = os.path.join(self.work_dir, 'inventory.db')
+        main.inventory.Inventory(self.db).record_build({
+            'path': '/var/lib/machines/CentOS_7_2-base',
+            'name': 'CentOS_7_2-base',
+            'destination': '/var/lib/machines',
+            'manifest_hash': 'abc',
+            'subvolume': True,
+            'logical_size': 1048576,
+            'disk_size': 2097152,
+            'packages': ['bash-0:4.2.46-20.el7_2.x86_64', 'filesystem-0:3.2-20.el7.x86_64'],
+            'phases': [('install', 12.5), ('fix_context', 1.25)],
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_command(self, cmd_class, argv):
+        args = self.dummy_parser.parse_args(argv)
+        out = StringIO.StringIO()
+        with mock.patch('sys.stdout', out):
+            cmd_class(args).run()
+        return out.getvalue()
+
+    def test_list(self):
+        out = self.run_command(self.list_class, ['list', '--inventory', self.db])
+        lines = out.splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[1].startswith('CentOS_7_2-base'))
+        self.assertIn('2.0M', lines[1])
+
+    def test_list_and_show_are_profiled(self):
+        profile_dir = os.path.join(self.work_dir, 'profile')
+        self.run_command(self.list_class, ['list', '--inventory', self.db, '--profile', profile_dir])
+        self.run_command(self.show_class, ['show', 'CentOS_7_2-base', '--inventory', self.db, '--profile', profile_dir])
+        self.assertTrue(os.path.exists(os.path.join(profile_dir, '01-list.prof')))
+        self.assertTrue(os.path.exists(os.path.join(profile_dir, '01-show.prof')))
+
+    def test_list_json(self):
+        out = self.run_command(self.list_class, ['list', '--inventory', self.db, '--json'])
+        containers = json.loads(out)
+        self.assertEqual(2, containers[0]['package_count'])
+        self.assertTrue(containers[0]['subvolume'])
+
+    def test_show(self):
+        out = self.run_command(self.show_class, ['show', 'CentOS_7_2-base', '--inventory', self.db])
+        self.assertIn('manifest hash: abc', out)
+        self.assertIn('packages (2):', out)
+        self.assertIn('bash-0:4.2.46-20.el7_2.x86_64', out)
+
+        out = self.run_command(self.show_class, ['show', '/var/lib/machines/CentOS_7_2-base', '--inventory', self.db, '--json'])
+        found = json.loads(out)
+        self.assertEqual([['install', 12.5], ['fix_context', 1.25]], found[0]['phases'])
+
+    def test_show_unknown(self):
+        with self.assertRaisesRegexp(RuntimeError, 'not in the inventory'):
+            self.run_command(self.show_class, ['show', 'missing', '--inventory', self.db])
+
+
+class WatchCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.dummy_parser = argparse.ArgumentParser()
+        self.cmd_class = main.WatchCommand.get_instance(self.dummy_parser.add_subparsers())
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_watch_")
+        self.db = os.path.join(self.work_dir, 'inventory.db')
+
+        self.repos = {}
+        for repo in ['base', 'updates']:
+            self.repos[repo] = os.path.join(self.work_dir, repo)
+            self.write_repomd(repo, 1)
+
+        # a and b share the base repo under different IDs
+        self.manifests = [
+            self.write_manifest('a', {'os': {'baseurl': 'file://%s' % self.repos['base']}}),
+            self.write_manifest('b', {'centos': {'baseurl': 'file://%s' % self.repos['base']}}),
+            self.write_manifest('c', {'updates': {'baseurl': 'file://%s' % self.repos['updates']}}),
+        ]
+        main.inventory.Inventory(self.db).record_build({
+            'path': os.path.join(self.work_dir, 'a'), 'name': 'a', 'destination': self.work_dir, 'subvolume': True,
+            'packages': ['bash-0:4.2.46-20.el7_2.x86_64'],
+        })
+        self.resolved = {
+            'a': ['bash-0:4.2.46-20.el7_2.x86_64'],
+            'b': ['bash-0:4.2.46-20.el7_2.x86_64'],
+            'c': ['bash-0:4.2.46-21.el7_3.x86_64'],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_repomd(self, repo, revision):
+        repodata = os.path.join(self.repos[repo], 'repodata')
+        if not os.path.isdir(repodata):
+            os.makedirs(repodata)
+        with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+            f.write("<repomd><revision>%d</revision></repomd>" % revision)
+
+    def write_manifest(self, name, repos):
+        path = os.path.join(self.work_dir, '%s.yaml' % name)
+        with open(path, 'w') as f:
+            yaml.safe_dump({
+                'name': name,
+                'destination': self.work_dir,
+                'subvolume': True,
+                'repos': repos,
+                'packages': ['bash'],
+            }, f)
+        return path
+
+    def poll(self, cmd_instance, poller, builds):
+        def resolve(builder):
+            resolved = self.resolved[builder.config['name']]
+            if isinstance(resolved, Exception):
+                raise resolved
+            return resolved
+        with mock.patch.object(self.cmd_class, 'resolve', side_effect=resolve) as mock_resolve, \
+            mock.patch('salmon.watch.repomd_revision', wraps=main.watch.repomd_revision) as mock_revision:
+            queued = cmd_instance.poll(poller, builds)
+        names = sorted(c[0][0].config['name'] for c in mock_resolve.call_args_list)
+        return queued, names, mock_revision.call_count
+
+    def test_poll(self):
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db, '--interval', '1'] + self.manifests)
+        cmd_instance = self.cmd_class(args)
+        poller = main.watch.RepoPoller(0)
+        builds = mock.Mock(**{'busy.return_value': False, 'submit.return_value': True, 'take_failed.return_value': []})
+
+        # Everything is resolved the first time.  a matches the inventory; b was never built.
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['a', 'b', 'c'], resolved)
+        self.assertEqual(2, polls)
+        self.assertEqual(self.manifests[1:], queued)
+        self.assertEqual(
+            [sys.executable, '-m', 'salmon.main', 'build', self.manifests[1], '--inventory', self.db],
+            builds.submit.call_args_list[0][0][1][-1]
+        )
+
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(([], [], 2), (queued, resolved, polls))
+
+        # Only manifests using the regenerated repo are resolved again
+        self.write_repomd('updates', 2)
+        self.resolved['c'] = self.resolved['a']
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['c'], resolved)
+        self.assertEqual([self.manifests[2]], queued)
+
+    def test_skips_busy_and_broken_manifests(self):
+        with open(self.manifests[0], 'w') as f:
+            f.write("name: a\n")
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        cmd_instance = self.cmd_class(args)
+        builds = mock.Mock(**{'submit.return_value': True, 'take_failed.return_value': []})
+        builds.busy.side_effect = lambda path: path == self.manifests[2]
+
+        queued, resolved, polls = self.poll(cmd_instance, main.watch.RepoPoller(0), builds)
+        self.assertEqual(['b'], resolved)
+        self.assertEqual([self.manifests[1]], queued)
+
+    def test_skips_base_image_manifests(self):
+        with open(self.manifests[0]) as f:
+            manifest = yaml.safe_load(f)
+        manifest['base_image'] = '/images/base.squashfs'
+        with open(self.manifests[0], 'w') as f:
+            yaml.safe_dump(manifest, f)
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        builds = mock.Mock(**{'busy.return_value': False, 'submit.return_value': True, 'take_failed.return_value': []})
+
+        queued, resolved, polls = self.poll(self.cmd_class(args), main.watch.RepoPoller(0), builds)
+        self.assertEqual(['b', 'c'], resolved)
+
+    def test_retries_until_handled(self):
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        cmd_instance = self.cmd_class(args)
+        poller = main.watch.RepoPoller(0)
+        builds = mock.Mock(**{'submit.return_value': True, 'take_failed.return_value': []})
+
+        # c is busy on the first poll and resolved on the second, though its repo hasn't changed since
+        builds.busy.side_effect = lambda path: path == self.manifests[2]
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['a', 'b'], resolved)
+        builds.busy.side_effect = None
+        builds.busy.return_value = False
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['c'], resolved)
+        self.assertEqual([self.manifests[2]], queued)
+
+        # A failed rebuild is retried
+        builds.take_failed.return_value = [self.manifests[1]]
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['b'], resolved)
+        builds.take_failed.return_value = []
+
+        # A manifest that couldn't be resolved is resolved again on the next poll
+        self.resolved['a'] = RuntimeError("repo unavailable")
+        self.write_repomd('base', 2)
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['a', 'b'], resolved)
+        self.resolved['a'] = self.resolved['b']
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['a'], resolved)
+
+        # Editing a manifest resolves it again even though its repos haven't changed
+        with open(self.manifests[0]) as f:
+            manifest = yaml.safe_load(f)
+        manifest['packages'].append('zsh')
+        with open(self.manifests[0], 'w') as f:
+            yaml.safe_dump(manifest, f)
+        queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual(['a'], resolved)
+        self.assertEqual(([], [], 2), self.poll(cmd_instance, poller, builds))
+
+    def test_once_exit_status(self):
+        for failed, status in [([], 0), ([self.manifests[0]], 1)]:
+            salmon = main.Salmon(['watch', '--once', '--inventory', self.db] + self.manifests)
+            builds = mock.Mock(failed=failed)
+            with mock.patch('salmon.watch.BuildQueue', return_value=builds), \
+                mock.patch.object(main.WatchCommand, 'poll'):
+                self.assertEqual(status, salmon.run())
+            self.assertTrue(builds.wait.called)
+
+    def test_unrecorded_container(self):
+        os.mkdir(os.path.join(self.work_dir, 'b'))
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        cmd_instance = self.cmd_class(args)
+        poller = main.watch.RepoPoller(0)
+        builds = mock.Mock(**{'busy.return_value': False, 'submit.return_value': True, 'take_failed.return_value': []})
+
+        # b was built before the inventory existed, so its rpmdb says what it has
+        with mock.patch.object(self.cmd_class, 'installed_packages', return_value=self.resolved['b']) as mock_rpmdb:
+            queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        mock_rpmdb.assert_called_with(os.path.join(self.work_dir, 'b'))
+        self.assertEqual([self.manifests[2]], queued)
+
+        # Without a readable rpmdb, b is rebuilt only once its packages change
+        cmd_instance = self.cmd_class(args)
+        poller = main.watch.RepoPoller(0)
+        with mock.patch.object(self.cmd_class, 'installed_packages', return_value=None):
+            queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+            self.assertEqual([self.manifests[2]], queued)
+            self.write_repomd('base', 2)
+            self.resolved['b'] = self.resolved['c']
+            queued, resolved, polls = self.poll(cmd_instance, poller, builds)
+        self.assertEqual([self.manifests[1]], queued)
+
+    def test_installed_packages(self):
+        cmd_instance = self.cmd_class(self.dummy_parser.parse_args(['watch'] + self.manifests))
+        output = "zsh-0:5.0.2-14.el7.x86_64\ngpg-pubkey-0:f4a80eb5-53a7ff4b.(none)\nbash-0:4.2.46-20.el7_2.x86_64\n"
+        with mock.patch('subprocess.check_output', return_value=output):
+            packages = cmd_instance.installed_packages('/var/lib/machines/test')
+        self.assertEqual(['bash-0:4.2.46-20.el7_2.x86_64', 'zsh-0:5.0.2-14.el7.x86_64'], packages)
+        with mock.patch('subprocess.check_output', side_effect=OSError("no rpm")):
+            self.assertIsNone(cmd_instance.installed_packages('/var/lib/machines/test'))
+
+    def test_rebuild_commands(self):
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        cmd_instance = self.cmd_class(args)
+        config = {'destination': self.work_dir, 'name': 'a', 'subvolume': False}
+        self.assertEqual([cmd_instance.build_command(self.manifests[0])], cmd_instance.rebuild_commands(self.manifests[0], config))
+
+        os.mkdir(os.path.join(self.work_dir, 'a'))
+        cmds = cmd_instance.rebuild_commands(self.manifests[0], config)
+        self.assertEqual(1, len(cmds))
+        self.assertTrue(callable(cmds[0]))
+
+    def replace_container(self, build):
+        args = self.dummy_parser.parse_args(['watch', '--inventory', self.db] + self.manifests)
+        config = {'destination': self.work_dir, 'name': 'a', 'subvolume': False}
+        container_dir = os.path.join(self.work_dir, 'a')
+        os.mkdir(container_dir)
+        open(os.path.join(container_dir, 'old'), 'w').close()
+        with mock.patch('subprocess.check_call', side_effect=build) as mock_build:
+            try:
+                self.cmd_class(args).replace_container(self.manifests[0], config)
+            finally:
+                self.assertFalse(os.path.exists(os.path.join(self.work_dir, '.a.salmon-previous')))
+        self.assertEqual('build', mock_build.call_args[0][0][3])
+        return container_dir
+
+    def test_replace_container(self):
+        def build(cmd):
+            os.mkdir(os.path.join(self.work_dir, 'a'))
+            open(os.path.join(self.work_dir, 'a', 'new'), 'w').close()
+
+        container_dir = self.replace_container(build)
+        self.assertEqual(['new'], os.listdir(container_dir))
+
+    def test_replace_container_keeps_old_container_when_build_fails(self):
+        def build(cmd):
+            os.mkdir(os.path.join(self.work_dir, 'a'))
+            raise subprocess.CalledProcessError(1, 'build')
+
+        self.assertRaises(subprocess.CalledProcessError, self.replace_container, build)
+        self.assertEqual(['old'], os.listdir(os.path.join(self.work_dir, 'a')))
+
 
 class DeleteCommandTest(unittest.TestCase):
     def setUp(self):
@@ -339,5 +1456,111 @@ class DeleteCommandTest(unittest.TestCase):
             expected_calls.append(mock.call(['btrfs', 'subvolume', 'delete', root % sub_dir]))
         self.assertEqual(expected_calls, mock_subprocess.mock_calls)
 
+    def test_do_command_removes_checkpoint(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        os.mkdir(os.path.join(dest, 'exist'))
+        cache_dir = os.path.join(dest, 'cache')
+        os.mkdir(cache_dir)
+
+        args = self.dummy_parser.parse_args(['delete'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': dest, 'name': 'exist', 'subvolume': True}
+        saved = main.checkpoint.Checkpoint(cmd_instance.checkpoint_path(cmd_instance.config))
+        saved.cache_dir = cache_dir
+        saved.save()
+        cmd_instance.validate_subcommand_config(args, cmd_instance.config, [])
+
+        with mock.patch('subprocess.check_output', return_value="OK"):
+            cmd_instance.do_command()
+
+        self.assertFalse(saved.exists())
+        self.assertFalse(os.path.exists(cache_dir))
+
+    def test_do_command_removes_failed_directory_build(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        container_dir = os.path.join(dest, 'exist')
+        os.makedirs(os.path.join(container_dir, 'etc'))
+        cache_dir = os.path.join(dest, 'cache')
+        os.mkdir(cache_dir)
+
+        args = self.dummy_parser.parse_args(['delete'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': dest, 'name': 'exist', 'subvolume': False}
+        self.assertEqual(1, len(cmd_instance.validate_subcommand_config(args, cmd_instance.config, [])))
+
+        saved = main.checkpoint.Checkpoint(cmd_instance.checkpoint_path(cmd_instance.config))
+        saved.cache_dir = cache_dir
+        saved.save()
+        self.assertEqual([], cmd_instance.validate_subcommand_config(args, cmd_instance.config, []))
+
+        with mock.patch('subprocess.check_output') as mock_subprocess:
+            cmd_instance.do_command()
+
+        self.assertFalse(mock_subprocess.called)
+        self.assertFalse(os.path.exists(container_dir))
+        self.assertFalse(saved.exists())
+        self.assertFalse(os.path.exists(cache_dir))
+
+    def test_do_command_updates_inventory(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        container_dir = os.path.join(dest, 'exist')
+        os.mkdir(container_dir)
+        db = os.path.join(dest, 'inventory.db')
+        main.inventory.Inventory(db).record_build({
+            'path': container_dir, 'name': 'exist', 'destination': dest, 'manifest_hash': 'abc', 'subvolume': True,
+            'packages': ['bash-0:4.2.46-20.el7_2.x86_64'],
+        })
+
+        args = self.dummy_parser.parse_args(['delete', '--inventory', db])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': dest, 'name': 'exist', 'subvolume': True}
+        with mock.patch('subprocess.check_output', return_value="OK"):
+            cmd_instance.do_command()
+
+        index = main.inventory.Inventory(db)
+        self.assertEqual([], index.containers())
+        history = index.conn.execute("SELECT action, manifest_hash FROM history ORDER BY id").fetchall()
+        self.assertEqual([('build', 'abc'), ('delete', 'abc')], [tuple(h) for h in history])
+
+    def test_inventory_errors_dont_stop_delete(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        os.mkdir(os.path.join(dest, 'exist'))
+
+        args = self.dummy_parser.parse_args(['delete'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': dest, 'name': 'exist', 'subvolume': True, 'nspawn_file': {'Exec': {}}}
+        with mock.patch('subprocess.check_output', return_value="OK"), \
+            mock.patch.object(main.inventory.Inventory, 'record_delete', side_effect=sqlite3.OperationalError("locked")), \
+            mock.patch('os.unlink') as mock_unlink:
+            cmd_instance.do_command()
+        mock_unlink.assert_called_with('/etc/systemd/nspawn/exist.nspawn')
+
+    def test_do_command_with_overlay(self):
+        dest = tempfile.mkdtemp(prefix="salmon_unit_test_dest_")
+        self.addCleanup(shutil.rmtree, dest)
+        unit_dir = os.path.join(dest, 'units')
+        overlay_dir = os.path.join(dest, '.salmon-overlays', 'exist')
+        for d in [unit_dir, os.path.join(overlay_dir, 'upper'), os.path.join(dest, 'exist')]:
+            os.makedirs(d)
+        open(os.path.join(unit_dir, '%s-exist.mount' % dest.strip('/').replace('/', '-')), 'w').close()
+
+        args = self.dummy_parser.parse_args(['delete'])
+        cmd_instance = self.cmd_class(args)
+        cmd_instance.config = {'destination': dest, 'name': 'exist', 'subvolume': False}
+        self.assertEqual([], cmd_instance.validate_subcommand_config(args, cmd_instance.config, []))
+
+        with mock.patch.object(self.cmd_class, 'UNIT_DIR', unit_dir), \
+            mock.patch('subprocess.check_output', side_effect=fake_systemd_escape) as mock_subprocess:
+            cmd_instance.do_command()
+
+        self.assertFalse(os.path.exists(overlay_dir))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'exist')))
+        self.assertEqual([], os.listdir(unit_dir))
+        self.assertIn(mock.call(['systemctl', 'daemon-reload']), mock_subprocess.mock_calls)
+
 if __name__ == "__main__":
     unittest.main(module="salmon")
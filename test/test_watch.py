@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import salmon.watch as watch
+
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <revision>%s</revision>
+  <data type="primary">
+    <checksum type="sha256">%s</checksum>
+    <location href="repodata/%s-primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+
+def write_repo(repo_dir, revision, checksum):
+    """Stand in for running createrepo_c on a repo"""
+    repodata = os.path.join(repo_dir, 'repodata')
+    if not os.path.isdir(repodata):
+        os.makedirs(repodata)
+    with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+        f.write(REPOMD % (revision, checksum, checksum))
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="salmon_unit_test_watch_")
+        self.repo_dir = os.path.join(self.work_dir, 'repo')
+        self.repo_url = "file://%s" % self.repo_dir
+        write_repo(self.repo_dir, 1470844800, 'aaaa')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_repomd_revision(self):
+        revision, digest = watch.repomd_revision(self.repo_url)
+        self.assertEqual('1470844800', revision)
+
+        # Regenerating within the same second keeps the revision but not the digest
+        write_repo(self.repo_dir, 1470844800, 'bbbb')
+        self.assertNotEqual(digest, watch.repomd_revision(self.repo_url)[1])
+
+    def test_repo_key(self):
+        self.assertIsNone(watch.repo_key({'metalink': 'https://example.com/metalink'}))
+        self.assertEqual(
+            (('baseurl', 'http://a.example.com'), ('mirrors', 'http://b.example.com')),
+            watch.repo_key({'mirrors': ['http://b.example.com'], 'baseurl': 'http://a.example.com', 'gpgcheck': 0})
+        )
+
+    def test_poller_reports_changes(self):
+        poller = watch.RepoPoller(interval=0)
+        key = watch.repo_key({'baseurl': self.repo_url})
+
+        self.assertEqual(set([key]), poller.changed([key]))
+        self.assertEqual(set(), poller.changed([key]))
+        write_repo(self.repo_dir, 1470844801, 'bbbb')
+        self.assertEqual(set([key]), poller.changed([key]))
+
+    def test_poller_respects_interval(self):
+        poller = watch.RepoPoller(interval=60)
+        key = watch.repo_key({'baseurl': self.repo_url})
+
+        with mock.patch.object(watch, 'repomd_revision', wraps=watch.repomd_revision) as mock_revision:
+            poller.changed([key], now=1000)
+            write_repo(self.repo_dir, 1470844801, 'bbbb')
+            self.assertEqual(set(), poller.changed([key], now=1059))
+            self.assertEqual(1, mock_revision.call_count)
+            self.assertEqual(set([key]), poller.changed([key], now=1060))
+            self.assertEqual(2, mock_revision.call_count)
+
+    def test_poller_fails_over(self):
+        poller = watch.RepoPoller(interval=0, timeout=1)
+        key = watch.repo_key({'mirrors': ["file://%s/missing" % self.work_dir, self.repo_url]})
+        self.assertEqual(set([key]), poller.changed([key]))
+
+        dead = watch.repo_key({'baseurl': "file://%s/missing" % self.work_dir})
+        self.assertEqual(set(), poller.changed([dead]))
+
+    def test_build_queue_limits_concurrency(self):
+        builds = watch.BuildQueue(2)
+        sleep = [sys.executable, '-c', 'import time; time.sleep(0.3)']
+
+        start = time.time()
+        for i in range(4):
+            self.assertTrue(builds.submit('manifest%d.yaml' % i, [sleep]))
+        self.assertFalse(builds.submit('manifest0.yaml', [sleep]))
+        self.assertTrue(builds.busy('manifest3.yaml'))
+        builds.wait()
+        elapsed = time.time() - start
+
+        self.assertTrue(0.6 <= elapsed < 1.2, elapsed)
+        self.assertFalse(builds.busy('manifest3.yaml'))
+        self.assertEqual([], builds.failed)
+
+    def test_build_queue_records_failures(self):
+        builds = watch.BuildQueue(1)
+        fail = [sys.executable, '-c', 'import sys; sys.exit(1)']
+        never = [sys.executable, '-c', 'open("%s", "w")' % os.path.join(self.work_dir, 'ran')]
+        builds.submit('manifest.yaml', [fail, never])
+        builds.wait()
+
+        self.assertEqual(['manifest.yaml'], builds.failed)
+        self.assertEqual(['manifest.yaml'], builds.take_failed())
+
+        def fail():
+            raise OSError("rename failed")
+        builds.submit('other.yaml', [fail, never])
+        builds.wait()
+        self.assertEqual(['other.yaml'], builds.take_failed())
+        self.assertEqual([], builds.take_failed())
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'ran')))
+
+
+if __name__ == "__main__":
+    unittest.main()